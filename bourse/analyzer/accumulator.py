@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+
+
+class DayAccumulator:
+    """
+        The accumulator keeps the open, close, high, low and volume of the
+        current trading day for each cid, in arrays indexed by cid.
+        Each processed file updates it, so closing a day costs
+        O(companies) whatever the number of snapshots of the day.
+    """
+    def __init__(self, size=1024):
+        """
+            @param size: the initial number of cids, the arrays grow as needed
+        """
+        self.open = np.full(size, np.nan)
+        self.close = np.full(size, np.nan)
+        self.high = np.full(size, np.nan)
+        self.low = np.full(size, np.nan)
+        self.volume = np.zeros(size, dtype=np.int64)
+        self.seen = np.zeros(size, dtype=bool)
+
+    def __grow(self, size: int):
+        size = max(size, 2 * len(self.seen))
+        extra = size - len(self.seen)
+        for name in ("open", "close", "high", "low"):
+            setattr(self, name, np.concatenate([getattr(self, name), np.full(extra, np.nan)]))
+        self.volume = np.concatenate([self.volume, np.zeros(extra, dtype=np.int64)])
+        self.seen = np.concatenate([self.seen, np.zeros(extra, dtype=bool)])
+
+    def add(self, cids: np.ndarray, values: np.ndarray, volumes: np.ndarray):
+        """
+            Update the day with the stocks of a file, in snapshot order.
+            Missing values are ignored, like a groupby aggregation would.
+            @param cids: the cid of each stock
+            @param values: the value of each stock
+            @param volumes: the volume of each stock
+        """
+        if len(cids) == 0:
+            return
+        cids = cids.astype(np.int64, copy=False)
+        if cids.max() >= len(self.seen):
+            self.__grow(cids.max() + 1)
+        self.seen[cids] = True
+        # volumes are cumulative over the session, keep the highest one
+        np.maximum.at(self.volume, cids, volumes.astype(np.int64, copy=False))
+
+        valid = ~np.isnan(values)
+        cids, values = cids[valid], values[valid]
+        if len(cids) == 0:
+            return
+        np.fmax.at(self.high, cids, values)
+        np.fmin.at(self.low, cids, values)
+
+        # first value of each cid in the file opens the day if it is not open yet
+        first_cids, first = np.unique(cids, return_index=True)
+        opening = np.isnan(self.open[first_cids])
+        self.open[first_cids[opening]] = values[first[opening]]
+        # last value of each cid in the file closes the day so far
+        last_cids, last = np.unique(cids[::-1], return_index=True)
+        self.close[last_cids] = values[len(values) - 1 - last]
+
+    def emit(self, date) -> pd.DataFrame:
+        """
+            Return the daystocks of the day, indexed by cid, and start a new day.
+            @param date: the date of the day
+        """
+        cids = np.flatnonzero(self.seen)
+        daystocks = pd.DataFrame(
+            {
+                "date": date,
+                "open": self.open[cids],
+                "close": self.close[cids],
+                "high": self.high[cids],
+                "low": self.low[cids],
+                "volume": self.volume[cids],
+            },
+            index=pd.Index(cids, name="cid"),
+        )
+        for array in (self.open, self.close, self.high, self.low):
+            array[cids] = np.nan
+        self.volume[cids] = 0
+        self.seen[cids] = False
+        return daystocks
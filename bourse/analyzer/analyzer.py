@@ -1,4 +1,7 @@
+import argparse
 import os
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from multiprocessing import get_context
 
@@ -7,43 +10,30 @@ import numpy as np
 import pandas as pd
 import sklearn
 import timescaledb_model as tsdb
-from commit import Committer
+from commit import Committer, connect, set_db_factory, write_companies
+from loader import Prefetcher
 from mylogging import getLogger
 from processor import Processor
+from registry import AllocatorManager, CompanyRegistry
+from spool import Spool, run_loader
+from timer import StageTimer
 
 log = getLogger(__name__)
-processor = Processor(log)
-committer = Committer(log)
 
 
-def compute_alias_date(filename: str):
+def store_file(processor, committer, filename, df, alias, date, prev_date, prev_alias):
     """
-        Compute the market alias from the filename 
-        along with the date of snapshot
+        Process and store a decoded file into the database through a batch process
+        @param processor: the stock processor
+        @param committer: the committer writing the batches
         @param filename: the name of the file to process
-    """
-    alias = filename.split()[0]
-    date_str = filename[:-4].replace(alias + " ", "")
-    date: datetime = dateutil.parser.parse(date_str)
-    return alias, date
-
-
-def store_file(filepath, nb_companies, prev_date, prev_alias):
-    """
-        Process and store a file into the database through a batch process
-        @param filepath: the path of the file to process
-        @param nb_companies: the number of companies
+        @param df: the dataframe of the file to process
+        @param alias: the market alias of the file
+        @param date: the date of the snapshot
         @param prev_date: the date of the previous file that has been processed
         @param prev_alias: the market alias of the previous file
                            that has been processed
     """
-    filename = os.path.basename(filepath)
-    # if db.is_file_done(filename):
-    #    log.debug("File has already been processed")
-    #    return nb_companies, prev_date, prev_alias
-    df = pd.read_pickle(filepath)
-
-    alias, date = compute_alias_date(filename)
     market = committer.get_market(alias)
     df["mid"] = market.iloc[0]["id"]
     df["date"] = date
@@ -52,43 +42,267 @@ def store_file(filepath, nb_companies, prev_date, prev_alias):
         processor.process_daystocks(prev_date)
 
     committer.commit_if_needed(processor, prev_date, prev_alias, alias)
-    nb_companies = processor.process_dataframe(df, nb_companies)
+    nb_companies = processor.process_dataframe(df, filename)
 
     return nb_companies, date.date(), alias
 
 
-def process_files(dir, nb_companies=0, nb_files_processed=0, previous_alias=""):
+def list_files(dir):
     """
-        Run through a directory and process all files into the database
+        Yield the path of every file of a directory in processing order
         @param dir: the path to the dir to process
-        @param nb_companies: the number of companies already processed
-        @param nb_files_processed: the number of files already processed
-        @param previous_alias: the market alias of the previous file
-                               that has been processed
     """
-    log.debug(dir)
     # we walk each directory and
-    # call recursively this function for each directory
-    # if we land on a file, we process this file
-    # we process them on the alphabetical ascending order
+    # we process files on the alphabetical ascending order
     # because we'd like to process every file of a trading day
     # (this will be our batch to commit)
     for root, dirs, files in os.walk(dir):
-        prev_date = None
+        dirs.sort()
         for file in sorted(files):
-            nb_companies, prev_date, previous_alias = store_file(
-                os.path.join(root, file), nb_companies, prev_date, previous_alias
-            )
-            nb_files_processed += 1
-            if nb_files_processed % 10 == 0:
-                log.debug(nb_files_processed)
-        for dir in sorted(dirs):
-            nb_files_processed, nb_companies = process_files(
-                dir, nb_companies=0, nb_files_processed=nb_files_processed
-            )
+            yield os.path.join(root, file)
+
+
+def select_files(dir, committer, incremental=False):
+    """
+        Return the paths of the files of a directory to process, in processing order
+        @param dir: the path to the dir to process
+        @param committer: the committer writing the batches
+        @param incremental: skip the files already stored in the database
+    """
+    files = list_files(dir)
+    if incremental:
+        files_done = committer.get_files_done()
+        log.info(f"{len(files_done)} files already stored")
+        files = (f for f in files if os.path.basename(f) not in files_done)
+    return files
+
+
+def process_files(dir, processor, committer, prefetcher, previous_alias="", incremental=False):
+    """
+        Run through a directory and process all files into the database
+        @param dir: the path to the dir to process
+        @param processor: the stock processor
+        @param committer: the committer writing the batches
+        @param prefetcher: the prefetcher decoding the files ahead
+        @param previous_alias: the market alias of the previous file
+                               that has been processed
+        @param incremental: skip the files already stored in the database
+    """
+    log.debug(dir)
+    files = select_files(dir, committer, incremental)
+    return ingest(files, processor, committer, prefetcher, previous_alias)
+
+
+def ingest(files, processor, committer, prefetcher, previous_alias=""):
+    """
+        Process files into the database
+        @param files: the paths of the files to process, in processing order
+        @param processor: the stock processor
+        @param committer: the committer writing the batches
+        @param prefetcher: the prefetcher decoding the files ahead
+        @param previous_alias: the market alias of the previous file
+                               that has been processed
+    """
+    nb_files_processed, nb_companies = 0, len(processor.registry)
+    prev_date, prev_root = None, None
+    for filepath, df, alias, date in prefetcher.load(files):
+        root = os.path.dirname(filepath)
+        if root != prev_root:
+            # every directory starts a new batch
+            if prev_date is not None:
+                processor.process_daystocks(prev_date)
+            prev_date, prev_root = None, root
+        nb_companies, prev_date, previous_alias = store_file(
+            processor, committer, os.path.basename(filepath), df, alias, date,
+            prev_date, previous_alias
+        )
+        nb_files_processed += 1
+        if nb_files_processed % 10 == 0:
+            log.debug(nb_files_processed)
+
+    # commit the last trading day
+    if prev_date is not None:
+        processor.process_daystocks(prev_date)
+    processor.flush_stocks()
+    committer.commit(processor)
     return nb_files_processed, nb_companies
 
 
+def process_market(files, allocator, pool_size, read_ahead, loader, write_method, daystocks=True,
+                   staging=False, db_factory=connect, spool=None):
+    """
+        Process the files of one market into the database, in a worker process
+        @param files: the paths of the files of the market, in processing order
+        @param allocator: the proxy of the allocator giving company ids
+        @param pool_size: the number of writers of the market
+        @param read_ahead: the number of files decoded ahead
+        @param loader: the pool used to decode the files ahead
+        @param write_method: how batches are written to the database
+        @param daystocks: compute the daystocks, False when the database
+                          builds them from the stocks
+        @param staging: write into the staging tables of a backfill
+        @param db_factory: builds the database of each process
+        @param spool: the spool the batches are written to, None to write them to the database
+    """
+    timer = StageTimer()
+    committer = Committer(log, pool_size, write_method, db_factory=db_factory, timer=timer,
+                          staging=staging, spool=spool)
+    processor = Processor(log, CompanyRegistry(allocator=allocator), timer, daystocks)
+    nb_files_processed, _ = ingest(files, processor, committer, Prefetcher(read_ahead, loader, timer))
+    committer.join()
+    for line in timer.report():
+        log.info(line)
+    if committer.db.query_stats is not None:
+        committer.db.query_stats.dump()
+    return nb_files_processed
+
+
+def process_markets(dir, committer, workers, read_ahead, loader, write_method, incremental=False,
+                    daystocks=True, staging=False, db_factory=connect, spool=None):
+    """
+        Run through a directory and process each market in its own process,
+        company ids being given by a shared allocator
+        @param dir: the path to the dir to process
+        @param committer: the committer of the main process
+        @param workers: the number of markets processed at the same time
+        @param read_ahead: the number of files decoded ahead by all the markets
+        @param loader: the pool used to decode the files ahead
+        @param write_method: how batches are written to the database
+        @param incremental: skip the files already stored in the database
+        @param daystocks: compute the daystocks, False when the database
+                          builds them from the stocks
+        @param staging: write into the staging tables of a backfill
+        @param db_factory: builds the database of each process
+        @param spool: the spool the batches are written to, None to write them to the database
+    """
+    log.debug(dir)
+    markets = {}
+    for filepath in select_files(dir, committer, incremental):
+        alias = os.path.basename(filepath).split()[0]
+        markets.setdefault(alias, []).append(filepath)
+
+    # markets are independent except for company ids,
+    # the cores are shared between their writers and loaders
+    pool_size = max(1, os.cpu_count() // workers)
+    read_ahead = max(1, read_ahead // workers) if read_ahead > 0 else 0
+    # the allocator stores the new companies with its own connection
+    manager = AllocatorManager(ctx=get_context("spawn"))
+    manager.start(set_db_factory, (db_factory,))
+    with manager:
+        allocator = manager.CompanyAllocator(
+            committer.get_companies(), partial(write_companies, method=write_method)
+        )
+        with ProcessPoolExecutor(workers, mp_context=get_context("spawn")) as executor:
+            # biggest markets first, so that they do not finish last
+            futures = {
+                alias: executor.submit(
+                    process_market, files, allocator, pool_size, read_ahead, loader, write_method,
+                    daystocks, staging, db_factory, spool
+                )
+                for alias, files in sorted(markets.items(), key=lambda m: -len(m[1]))
+            }
+            for alias, future in futures.items():
+                log.info(f"{alias}: {future.result()} files processed")
+
+
 if __name__ == "__main__":
-    process_files("./data/")
+    parser = argparse.ArgumentParser(description="Store boursorama files into the database")
+    parser.add_argument("dir", nargs="?", default="./data/", help="the directory to process")
+    parser.add_argument("--read-ahead", type=int, default=os.cpu_count(),
+                        help="number of files decoded ahead of the processor, 0 to disable")
+    parser.add_argument("--loader", choices=["process", "thread"], default="process",
+                        help="pool used to decode the files ahead")
+    parser.add_argument("--incremental", action="store_true",
+                        help="skip the files already stored in the database")
+    parser.add_argument("--markets", type=int, default=0,
+                        help="number of markets processed in parallel, each in its own process"
+                             " (0 to process them one after another)")
+    parser.add_argument("--write-method", choices=["copy", "to_sql"], default="copy",
+                        help="how batches are written to the database")
+    parser.add_argument("--aggregates", action="store_true",
+                        help="create weekly and monthly continuous aggregates of the daystocks")
+    parser.add_argument("--daystocks", choices=["compute", "aggregate"], default="compute",
+                        help="compute the daystocks, or let continuous aggregates"
+                             " of the stocks build the daily, weekly and monthly bars")
+    parser.add_argument("--compress-after", default=None,
+                        help="compress the chunks older than this interval (e.g. '30 days')"
+                             " with a policy, see maintenance.py to compress after a backfill")
+    parser.add_argument("--backfill", action="store_true",
+                        help="drop the secondary indexes during the load and build them at the end")
+    parser.add_argument("--staging", action="store_true",
+                        help="with --backfill, load into UNLOGGED staging tables merged at the end")
+    parser.add_argument("--sql-stats", action="store_true",
+                        help="count the calls, latency and rows of each query and log them")
+    parser.add_argument("--sql-stats-every", type=float, default=None,
+                        help="with --sql-stats, also log the stats of each process every N seconds")
+    parser.add_argument("--slow-query-ms", type=float, default=None,
+                        help="with --sql-stats, log the queries slower than this to /tmp/bourse-slow.log")
+    parser.add_argument("--spool", default=None, metavar="DIR",
+                        help="write the batches as Parquet files into DIR, a loader process"
+                             " loads them into the database (replay with: python3 spool.py DIR)")
+    args = parser.parse_args()
+    if args.staging and not args.backfill:
+        parser.error("--staging requires --backfill")
+    if args.staging and args.spool:
+        parser.error("--staging can not be used with --spool")
+
+    db_factory = connect
+    if args.sql_stats:
+        slow_query_seconds = args.slow_query_ms / 1000 if args.slow_query_ms is not None else None
+        db_factory = partial(connect, query_stats=True, slow_query_seconds=slow_query_seconds,
+                             stats_dump_seconds=args.sql_stats_every)
+
+    spool, spool_loader = None, None
+    if args.spool:
+        spool = Spool(args.spool)
+
+    timer = StageTimer()
+    committer = Committer(log, write_method=args.write_method, db_factory=db_factory, timer=timer,
+                          staging=args.staging, spool=spool)
+    daystocks = args.daystocks == "compute"
+    # the schema is created once, before any worker connects
+    if not daystocks:
+        committer.db.setup_database("stocks", args.compress_after)
+    else:
+        committer.db.setup_database("daystocks" if args.aggregates else None, args.compress_after)
+    if args.backfill:
+        committer.db.drop_indexes()
+        if args.staging:
+            committer.db.create_staging_tables()
+    if spool is not None:
+        # the loader drains the spool until the processing is over
+        ctx = get_context("spawn")
+        stop_loader = ctx.Event()
+        spool_loader = ctx.Process(target=run_loader, args=(args.spool, stop_loader, db_factory))
+        spool_loader.start()
+    if args.markets > 0:
+        process_markets(args.dir, committer, args.markets, args.read_ahead, args.loader,
+                        args.write_method, incremental=args.incremental, daystocks=daystocks,
+                        staging=args.staging, db_factory=db_factory, spool=spool)
+    else:
+        processor = Processor(log, CompanyRegistry(committer.get_companies()), timer, daystocks)
+        prefetcher = Prefetcher(args.read_ahead, args.loader, timer)
+        process_files(args.dir, processor, committer, prefetcher, incremental=args.incremental)
+    committer.join()
+    if spool_loader is not None:
+        stop_loader.set()
+        with timer.stage("spool"):
+            spool_loader.join()
+        if spool_loader.exitcode != 0:
+            log.error(f"The spool loader failed, the batches left in {args.spool} can be"
+                      f" loaded with: python3 spool.py {args.spool}")
+    if args.backfill:
+        if args.staging:
+            with timer.stage("merge"):
+                committer.db.merge_staging_tables()
+        # the time spent maintaining the indexes during a normal load
+        with timer.stage("indexes"):
+            committer.db.create_indexes()
+    if not daystocks or args.aggregates:
+        # the refresh policies only cover the last buckets
+        committer.db.refresh_aggregates()
+    for line in timer.report():
+        log.info(line)
+    if committer.db.query_stats is not None:
+        committer.db.query_stats.dump()
     log.debug("Done")
@@ -1,53 +1,223 @@
 import os
+from collections import deque
 from datetime import datetime
 from itertools import repeat
 from multiprocessing import get_context
+from multiprocessing.util import Finalize
 
 import pandas as pd
+import psycopg2
 import timescaledb_model as tsdb
 
 from processor import Processor
+from timer import StageTimer
 
-db = tsdb.TimescaleStockMarketModel("bourse", "ricou", "db", "monmdp")  # inside docker
-# db = tsdb.TimescaleStockMarketModel(
-#     "bourse", "ricou", "localhost", "monmdp"
-# )  # outside docker
+
+def connect(**options):
+    """
+        Build the database model, options are given to TimescaleStockMarketModel
+    """
+    return tsdb.TimescaleStockMarketModel("bourse", "ricou", "db", "monmdp", **options)  # inside docker
+    # return tsdb.TimescaleStockMarketModel(
+    #     "bourse", "ricou", "localhost", "monmdp"
+    # )  # outside docker
+
+
+# the database of this process, built by db_factory when first used
+db_factory = connect
+db = None
+
+
+def get_db():
+    global db
+    if db is None:
+        db = db_factory()
+        if db.query_stats is not None:
+            # the stats of a pool worker are logged when it exits
+            Finalize(None, db.query_stats.dump, exitpriority=10)
+    return db
+
+
+def set_db_factory(factory):
+    """
+        Make this process write with the database built by factory,
+        this is the initializer of the writer pool.
+        @param factory: a picklable callable returning a database
+    """
+    global db_factory, db
+    db_factory, db = factory, None
+
+
+def write_companies(companies: pd.DataFrame, method: str = "copy"):
+    """
+        Commit new companies at once, with the database of this process.
+        @param companies: the companies, indexed by their id
+        @param method: "copy" or "to_sql"
+    """
+    Committer.write_batch([("companies", companies)], [], method)
 
 
 class Committer:
     """
         The committer is used to commit processed DataFrame to the database
         efficiently through a processpool.
+        DataFrames are bulk loaded with COPY, or inserted with to_sql
+        when the write method is "to_sql".
+        The pool lives as long as the committer, so each worker keeps its
+        database connection, and batches are written asynchronously: at most
+        max_inflight batches are pending before a commit waits for the oldest.
+        A worker writes the stocks and daystocks of a batch and records the
+        names of its files in file_done in the same transaction, so a failed
+        batch is processed again. Batches are written in any order, the new
+        companies are thus committed by the committer itself before the
+        batch using their ids is submitted.
     """
     @staticmethod
-    def commit_companies(df: pd.DataFrame):
-        db.df_write(df, "companies")
-
-    @staticmethod
-    def commit_stocks(df: pd.DataFrame):
-        db.df_write(df, "stocks")
-
-    @staticmethod
-    def commit_daystocks(df: pd.DataFrame):
-        db.df_write(df, "daystocks")
+    def write_batch(frames: list, files: list, method: str = "copy", file_table: str = "file_done"):
+        """
+            Write the DataFrames of a batch and record its files in one transaction,
+            falling back to to_sql if COPY fails.
+            @param frames: the (table, dataframe) pairs of the batch
+            @param files: the names of the files of the batch
+            @param method: "copy" or "to_sql"
+            @param file_table: the table of the names of the files
+        """
+        db = get_db()
+        if method == "copy":
+            try:
+                db.copy_batch(frames, files, file_table)
+                return
+            except psycopg2.Error as e:
+                db.logger.exception(f"COPY of a batch failed, using to_sql: {e}")
+                db.rollback()
+        db.df_write_batch(frames, files, file_table)
 
-    def __init__(self, log, pool_size=os.cpu_count()):
+    def __init__(self, log, pool_size=os.cpu_count(), write_method="copy", max_inflight=None,
+                 db_factory=connect, timer=None, staging=False, spool=None, batch_days=1):
+        """
+            @param max_inflight: the number of batches written at once,
+                                 one per worker of the pool by default
+            @param batch_days: the number of days of a batch; at most
+                               batch_days * max_inflight days are held in memory
+            @param staging: write stocks, daystocks and file_done into their
+                            UNLOGGED staging tables, merged at the end of a backfill
+            @param spool: write the batches into this Spool instead of the
+                          database, a loader process drains it
+        """
         self.pool_size = pool_size
+        self.write_method = write_method
+        self.max_inflight = max_inflight if max_inflight is not None else pool_size
+        self.batch_days = batch_days
         self.log = log
-        self.db = db
+        self.db_factory = db_factory
+        # tables the batches are written to
+        self.tables = {
+            table: f"{table}_staging" if staging else table
+            for table in ("stocks", "daystocks", "file_done")
+        }
+        set_db_factory(db_factory)
+        self.db = get_db()
+        self.timer = timer if timer is not None else StageTimer()
+        self.spool = spool
+        self.pool = None
+        # async results of the batches being written, oldest first
+        self.inflight = deque()
 
-    def __convert_generator_to_df(self, gen):
-        dflist = []
-        for gen in gen:
-            dflist.append(gen)
-        df = pd.concat(dflist)
-        return df
+    def get_files_done(self):
+        files = self.db.get_files_done()
+        if self.spool is not None:
+            # spooled files are not loaded yet but must not be processed again
+            files |= self.spool.pending_files()
+        return files
 
-    def get_market(self, alias: str):
-        return self.__convert_generator_to_df(
-            db.df_query(f"SELECT id FROM markets WHERE alias = '{alias}'")
+    def get_companies(self):
+        return pd.DataFrame(
+            self.db.query_arrays("SELECT id, symbol FROM companies"), columns=["id", "symbol"]
         )
 
+    def get_market(self, alias: str):
+        return pd.DataFrame(self.db.execute_prepared("market_id", (alias,)), columns=["id"])
+
+    def __get_pool(self):
+        if self.pool is None:
+            self.pool = get_context("spawn").Pool(
+                self.pool_size, initializer=set_db_factory, initargs=(self.db_factory,)
+            )
+        return self.pool
+
+    def __wait_batch(self):
+        """
+            Wait for the oldest batch in flight to be written.
+            Raise the exception of a worker if the batch failed.
+        """
+        self.inflight.popleft().get()
+
+    def __reap_batches(self):
+        """
+            Forget the batches that have been written, without blocking.
+        """
+        while self.inflight and self.inflight[0].ready():
+            self.__wait_batch()
+
+    def commit(self, proc: Processor):
+        """
+            Submit the processed dataframes to the writer pool and reset the batches.
+            Block only while max_inflight batches are still being written.
+
+            @param proc: a stock processor
+        """
+        if not proc.stocks_batch:
+            return
+        # we have to clean the stocks batches before committing
+        # so that we remove all duplicate values of a same day,
+        # a batch is written by one worker
+        proc.clean_stocks(1)
+
+        with self.timer.stage("commit"):
+            self.timer.count("commit", sum(
+                len(df) for batch in (proc.companies_batch, proc.stocks_batch, proc.daystocks_batch)
+                for df in batch
+            ))
+            if self.spool is not None:
+                # the loader records the files once the batch is loaded
+                self.spool.write(proc.companies_batch, proc.stocks_batch,
+                                 proc.daystocks_batch, proc.files_batch)
+                proc.reset_batch()
+                return
+
+            self.__reap_batches()
+            while len(self.inflight) >= self.max_inflight:
+                self.log.debug("Waiting for a batch to be written")
+                self.__wait_batch()
+
+            companies = [("companies", df) for df in proc.companies_batch if len(df) > 0]
+            if companies:
+                # a failed batch must not take away the companies of the next ones
+                Committer.write_batch(companies, [], self.write_method)
+
+            self.log.debug(f"Committing {len(proc.files_batch)} files to db")
+            frames = (
+                [(self.tables["stocks"], df) for df in proc.stocks_batch]
+                + [(self.tables["daystocks"], df) for df in proc.daystocks_batch]
+            )
+            self.inflight.append(self.__get_pool().apply_async(
+                Committer.write_batch, (frames, proc.files_batch),
+                dict(method=self.write_method, file_table=self.tables["file_done"])
+            ))
+            proc.reset_batch()
+
+    def join(self):
+        """
+            Wait for every batch in flight to be written and stop the writer pool.
+        """
+        with self.timer.stage("commit"):
+            while self.inflight:
+                self.__wait_batch()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
     def commit_if_needed(
         self, proc: Processor, prev_date: datetime, prev_alias: str, alias: str
     ):
@@ -59,23 +229,9 @@ class Committer:
             @param prev_alias: the market alias of the previous file that has been processed
             @param alias: the current market alias to store
         """
-        # if we have enough daystocks processed in our batch so that
-        # each process will commit one daystock
-        # we commit all batches to database and then reset the batches
-        if len(proc.daystocks_batch) == self.pool_size or (
+        # a batch is written by a single worker, the workers share the
+        # batches in flight rather than the days of a batch
+        if proc.days >= self.batch_days or (
             prev_date is None and alias != prev_alias and prev_alias != ""
         ):
-            # we have to clean the stocks batches before committing
-            # so that we remove all duplicate values of a same day
-            proc.clean_stocks(self.pool_size)
-
-            self.log.debug(f"Committing {len(proc.stocks_batch)} files to db")
-            with get_context("spawn").Pool(self.pool_size) as p:
-                self.log.info("..........")
-                p.map(Committer.commit_companies, proc.companies_batch)
-                self.log.info("===>......")
-                p.map(Committer.commit_stocks, proc.stocks_batch)
-                self.log.info("======>...")
-                p.map(Committer.commit_daystocks, proc.daystocks_batch)
-                self.log.info("=========>")
-                proc.reset_batch()
+            self.commit(proc)
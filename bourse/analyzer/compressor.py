@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+
+
+class RunLengthCompressor:
+    """
+        The compressor removes repeating stock values: of each run of rows
+        of a cid with the same value, volume and day, only the first and
+        the last rows are kept.
+        Rows are compressed as they come, in arrays indexed by cid holding
+        the open run of each cid. The last row of an open run is held back
+        until the run ends, so runs crossing batches are compressed too.
+    """
+    def __init__(self, size=1024):
+        """
+            @param size: the initial number of cids, the arrays grow as needed
+        """
+        # key of the open run of each cid
+        self.running = np.zeros(size, dtype=bool)
+        self.value = np.full(size, np.nan)
+        self.volume = np.zeros(size, dtype=np.int64)
+        self.day = np.zeros(size, dtype="datetime64[D]")
+        # row ending the open run, not emitted yet
+        self.pending = np.zeros(size, dtype=bool)
+        self.pending_date = np.zeros(size, dtype="datetime64[ns]")
+
+    def __grow(self, size: int):
+        size = max(size, 2 * len(self.running))
+        for name in ("running", "value", "volume", "day", "pending", "pending_date"):
+            array = getattr(self, name)
+            extra = np.full(size - len(array), np.nan) if name == "value" \
+                else np.zeros(size - len(array), dtype=array.dtype)
+            setattr(self, name, np.concatenate([array, extra]))
+
+    def __frame(self, cids, dates, values, volumes):
+        return pd.DataFrame(
+            {"volume": volumes, "date": dates, "value": values},
+            index=pd.Index(cids, name="cid"),
+        )
+
+    def compress(self, stocks: pd.DataFrame) -> pd.DataFrame:
+        """
+            Compress stocks given in time order and return the rows to store:
+            rows starting a run, rows ending a run, and held back rows whose
+            run has ended.
+            @param stocks: stocks indexed by cid, with date, volume and value
+        """
+        if len(stocks) == 0:
+            return stocks
+        cids = stocks.index.to_numpy().astype(np.int64)
+        order = np.lexsort((stocks["date"].to_numpy(), cids))
+        cids = cids[order]
+        dates = stocks["date"].to_numpy().astype("datetime64[ns]")[order]
+        values = stocks["value"].to_numpy()[order]
+        volumes = stocks["volume"].to_numpy().astype(np.int64)[order]
+        days = dates.astype("datetime64[D]")
+        if cids.max() >= len(self.running):
+            self.__grow(cids.max() + 1)
+
+        # key of the previous row of each row: the row before it
+        # if it is of the same cid, the open run of the cid otherwise
+        after_same = np.r_[False, cids[1:] == cids[:-1]]
+        before_same = np.r_[after_same[1:], False]
+        prev_value = np.where(after_same, np.r_[np.nan, values[:-1]], self.value[cids])
+        prev_volume = np.where(after_same, np.r_[0, volumes[:-1]], self.volume[cids])
+        prev_day = np.where(after_same, np.r_[days[:1], days[:-1]], self.day[cids])
+        continues = (
+            (after_same | self.running[cids])
+            & (values == prev_value)
+            & (volumes == prev_volume)
+            & (days == prev_day)
+        )
+        starts = ~continues
+        # a row ends its run when the next row of its cid starts a new one
+        ends = before_same & np.r_[starts[1:], False]
+        keep = starts | ends
+
+        # held back rows end their run when the first row of their cid starts a new one
+        ended = cids[~after_same & starts & self.pending[cids]]
+        compressed = self.__frame(
+            np.concatenate([ended, cids[keep]]),
+            np.concatenate([self.pending_date[ended], dates[keep]]),
+            np.concatenate([self.value[ended], values[keep]]),
+            np.concatenate([self.volume[ended], volumes[keep]]),
+        )
+
+        # the last row of each cid opens its run, and is held back
+        # if it is not the first row of the run
+        last = ~before_same
+        last_cids = cids[last]
+        self.running[last_cids] = True
+        self.value[last_cids] = values[last]
+        self.volume[last_cids] = volumes[last]
+        self.day[last_cids] = days[last]
+        self.pending[last_cids] = continues[last]
+        self.pending_date[last_cids] = dates[last]
+        return compressed
+
+    def flush(self, day=None) -> pd.DataFrame:
+        """
+            Return the held back rows of the runs that can not go on anymore.
+            @param day: the last day that is over, None to flush every run
+        """
+        pending = self.pending.copy()
+        if day is not None:
+            pending &= self.day <= np.datetime64(day, "D")
+        cids = np.flatnonzero(pending)
+        self.pending[cids] = False
+        return self.__frame(cids, self.pending_date[cids], self.value[cids], self.volume[cids])
@@ -0,0 +1,92 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+from multiprocessing import get_context
+
+import dateutil.parser
+import pandas as pd
+
+from timer import StageTimer
+
+
+def compute_alias_date(filename: str):
+    """
+        Compute the market alias from the filename
+        along with the date of snapshot
+        @param filename: the name of the file to process
+    """
+    alias = filename.split()[0]
+    date_str = filename[:-4].replace(alias + " ", "")
+    date: datetime = dateutil.parser.parse(date_str)
+    return alias, date
+
+
+def load_file(filepath: str):
+    """
+        Decode a snapshot file
+        @param filepath: the path of the file to load
+        @return: the dataframe, the market alias and the date of the snapshot
+    """
+    df = pd.read_pickle(filepath)
+    alias, date = compute_alias_date(os.path.basename(filepath))
+    return df, alias, date
+
+
+class Prefetcher:
+    """
+        The prefetcher decodes the upcoming files in a pool of workers
+        while the processor works on the current one.
+        Files are delivered in the order they are given, and at most
+        depth files are decoded ahead so that memory stays bounded.
+    """
+    def __init__(self, depth=os.cpu_count(), executor="process", timer=None):
+        """
+            @param depth: the number of files decoded ahead, 0 to load
+                          each file on the main process when it is needed
+            @param executor: "process" or "thread"
+            @param timer: the timer of the "load" stage, the time the
+                          processor waits for the files
+        """
+        self.depth = depth
+        self.executor = executor
+        self.timer = timer if timer is not None else StageTimer()
+
+    def __loaded(self, filepath, df, alias, date):
+        self.timer.count("load", len(df))
+        return filepath, df, alias, date
+
+    def __make_executor(self):
+        workers = min(self.depth, os.cpu_count())
+        if self.executor == "thread":
+            return ThreadPoolExecutor(workers)
+        return ProcessPoolExecutor(workers, mp_context=get_context("spawn"))
+
+    def load(self, filepaths):
+        """
+            Yield (filepath, df, alias, date) for each file, in order.
+            @param filepaths: an iterable of the paths of the files to load
+        """
+        if self.depth <= 0:
+            for filepath in filepaths:
+                with self.timer.stage("load"):
+                    loaded = load_file(filepath)
+                yield self.__loaded(filepath, *loaded)
+            return
+
+        filepaths = iter(filepaths)
+        with self.__make_executor() as executor:
+            # bounded queue of the files being decoded, in order
+            pending = deque()
+            for filepath in filepaths:
+                pending.append((filepath, executor.submit(load_file, filepath)))
+                if len(pending) == self.depth:
+                    break
+            while pending:
+                filepath, future = pending.popleft()
+                for next_filepath in filepaths:
+                    pending.append((next_filepath, executor.submit(load_file, next_filepath)))
+                    break
+                with self.timer.stage("load"):
+                    loaded = future.result()
+                yield self.__loaded(filepath, *loaded)
@@ -0,0 +1,63 @@
+import argparse
+
+from commit import connect
+from mylogging import getLogger
+
+log = getLogger(__name__)
+
+
+def format_size(size):
+    """
+        Format a size in bytes for humans
+        @param size: the size in bytes
+    """
+    for unit in ["B", "kB", "MB", "GB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+
+def report_sizes(before, after=None):
+    """
+        Log the size of each hypertable, and its size after a maintenance
+        @param before: the size of each hypertable
+        @param after: the size of each hypertable after the maintenance
+    """
+    for table, size in sorted(before.items()):
+        if after is None:
+            log.info(f"{table}: {format_size(size)}")
+        else:
+            saved = 1 - after[table] / size if size else 0
+            log.info(f"{table}: {format_size(size)} -> {format_size(after[table])} ({saved:.0%} saved)")
+
+
+def compress(db, tables, older_than=None):
+    """
+        Compress the chunks of hypertables, after a backfill for instance,
+        and report their storage before and after
+        @param db: the database
+        @param tables: the names of the hypertables to compress
+        @param older_than: None for every chunk, or an interval such as "7 days"
+    """
+    before = db.storage_sizes()
+    for table in tables:
+        log.info(f"{table}: {db.compress_chunks(table, older_than)} chunks compressed")
+    report_sizes(before, db.storage_sizes())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintain the hypertables of the database")
+    parser.add_argument("action", choices=["compress", "sizes"],
+                        help="compress the chunks, or only report the size of the hypertables")
+    parser.add_argument("--tables", nargs="+", default=["stocks", "daystocks"],
+                        help="the hypertables to compress")
+    parser.add_argument("--older-than", default=None,
+                        help="only compress the chunks older than this interval (e.g. '7 days')")
+    args = parser.parse_args()
+
+    db = connect()
+    if args.action == "compress":
+        compress(db, args.tables, args.older_than)
+    else:
+        report_sizes(db.storage_sizes())
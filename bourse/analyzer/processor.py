@@ -1,28 +1,85 @@
+import re
+from functools import lru_cache
+
 import numpy as np
 import pandas as pd
 
+from accumulator import DayAccumulator
+from compressor import RunLengthCompressor
+from registry import CompanyRegistry
+from timer import StageTimer
+
+# letters in parentheses (like "(c)") and thousands separators in values
+VALUE_NOISE = re.compile(r"\([a-zA-Z]\)| ")
+
+
+@lru_cache(maxsize=1 << 16)
+def parse_value(value: str) -> float:
+    """
+        Parse a value that is not a plain number, such as "12.5(c)" or "1 234.5"
+        @param value: the string to parse
+    """
+    return float(VALUE_NOISE.sub("", value))
+
+
+def normalize_values(values: pd.Series) -> pd.Series:
+    """
+        Convert raw values to float, as removing letters and spaces from
+        their string form would. Only the values that are not numbers
+        already go through string parsing, once per distinct string.
+        @param values: the raw values of a snapshot
+    """
+    raw = values.to_numpy()
+    try:
+        # most snapshots hold numbers only
+        numbers = raw.astype(float)
+    except (TypeError, ValueError):
+        numbers = pd.to_numeric(raw, errors="coerce").astype(float)
+        todo = np.isnan(numbers) & ~pd.isna(raw)
+        if todo.any():
+            codes, distinct = pd.factorize(raw[todo])
+            numbers[todo] = np.array([parse_value(str(value)) for value in distinct])[codes]
+    return pd.Series(numbers, index=values.index, name=values.name)
+
 
 class Processor:
     """
         The Processor is used to load dataframes from files and
         process, clean and compress them.
     """
-    def __init__(self, log):
+    def __init__(self, log, registry: None | CompanyRegistry = None, timer: None | StageTimer = None,
+                 daystocks: bool = True):
+        """
+            @param registry: the registry giving the company ids
+            @param timer: the timer of the processing stages
+            @param daystocks: compute the daystocks, False when the database
+                              builds them from the stocks (continuous aggregates)
+        """
         # This will be our batch lists.
         # each batch is composed of a number of dataframes
         self.stocks_batch = []
-        self.day_batch = []
         self.daystocks_batch = []
         self.companies_batch = []
-        # This dataframe stores every companies that have been already processed
-        self.companies_save: None | pd.DataFrame = None
+        # open, close, high, low and volume of the current day
+        self.day = DayAccumulator()
+        # removes repeating stock values, so that we store fewer value in database
+        self.compressor = RunLengthCompressor()
+        # names of the files of the current day, and of the files
+        # whose day is complete in the batch
+        self.day_files = []
+        self.files_batch = []
+        # number of trading days closed in the batch
+        self.days = 0
+        self.daystocks = daystocks
+        # This registry knows every company that has been already processed
+        self.registry = registry if registry is not None else CompanyRegistry()
         self.log = log
+        self.timer = timer if timer is not None else StageTimer()
 
-    def __process_companies(self, df: pd.DataFrame | pd.Series, nb_companies: int):
+    def __process_companies(self, df: pd.DataFrame | pd.Series):
         """
             Process the dataframe and fill up the company table.
             @param df: the dataframe to process
-            @param nb_companies: the number of companies processed
         """
         df.drop("symbol", axis=1, inplace=True)
         df.dropna(inplace=True)
@@ -31,25 +88,10 @@ class Processor:
             df.reset_index()
             .drop_duplicates("symbol")
             .drop(columns=["last", "volume", "date"])
-            .reset_index(drop=True)
         )
-        companies.index.rename("id", inplace=True)
-
-        if self.companies_save is None:
-            self.companies_save = companies
-            return companies, nb_companies + len(companies)
-        else:
-            # detecting new companies
-            mask = companies.symbol.isin(self.companies_save.symbol)
-            new_companies = companies[~mask].copy()
-            new_companies.reset_index(drop=True, inplace=True)
-            new_companies.index.rename("id", inplace=True)
-            new_companies.index += nb_companies
-
-            # saving new companies
-            self.companies_save = pd.concat([self.companies_save, new_companies])
-            # return updated list of companies
-            return new_companies, nb_companies + len(new_companies)
+
+        # return the new companies, with their id
+        return self.registry.register(companies)
 
     def __process_stocks(self, df: pd.DataFrame | pd.Series):
         """
@@ -57,109 +99,97 @@ class Processor:
             @param df: the dataframe to process
         """
         # add cid (company id) to stocks
-        stocks = df.reset_index().merge(
-            self.companies_save.assign(cid=self.companies_save.index)[
-                ["symbol", "cid"]
-            ],
-            on="symbol",
-            how="left",
-        )
-        stocks.set_index("cid", inplace=True)
+        stocks = df.reset_index()
+        stocks.index = pd.Index(self.registry.lookup(stocks["symbol"]), name="cid")
         stocks = stocks.drop(columns=["symbol", "name", "mid"])
 
-        # rename "last" to "value" to follow database format 
-        stocks["value"] = stocks["last"].astype(str)
+        # rename "last" to "value" to follow database format
+        # removing letters in value field and converting to float
+        stocks["value"] = normalize_values(stocks["last"])
         stocks.drop(axis=1, labels="last", inplace=True)
 
-        # remove letters in value field and convert to float
-        stocks["value"] = stocks["value"].str.replace("\([a-zA-Z]\)| ", "", regex=True)
-        stocks["value"] = stocks["value"].astype(float)
-
         # return processed stocks
         return stocks
 
-    def process_dataframe(self, df: pd.DataFrame | pd.Series, nb_companies: int):
+    def process_dataframe(self, df: pd.DataFrame | pd.Series, filename=None):
         """
             Process the dataframe of a file by extracting its data and put it
             in the company and stocks table.
             @param df: the dataframe to process
-            @param nb_companies: the number of companies processed
+            @param filename: the name of the file, recorded once its day is committed
+            @return: the number of companies known
         """
         # companies, stocks, daystocks, ~~file_done~~, ~~tags~~
-        companies, nb_companies = self.__process_companies(df, nb_companies)
-        stocks = self.__process_stocks(df)
+        with self.timer.stage("companies"):
+            companies = self.__process_companies(df)
+        with self.timer.stage("stocks"):
+            stocks = self.__process_stocks(df)
+        with self.timer.stage("clean"):
+            compressed = self.compressor.compress(stocks)
+        if self.daystocks:
+            with self.timer.stage("daystocks"):
+                self.day.add(
+                    stocks.index.to_numpy(),
+                    stocks["value"].to_numpy(),
+                    stocks["volume"].to_numpy(),
+                )
+        self.timer.count("companies", len(companies))
+        self.timer.count("stocks", len(stocks))
+        self.timer.count("clean", len(compressed))
 
         self.companies_batch.append(companies)
-        self.stocks_batch.append(stocks)
-        self.day_batch.append(stocks)
+        self.stocks_batch.append(compressed)
+        if filename is not None:
+            self.day_files.append(filename)
 
-        return nb_companies
+        return len(self.registry)
 
     def process_daystocks(self, prev_date):
         """
-            From the processed stocks batch, create a daystock out of it
+            From the stocks processed this day, create a daystock out of it
             @param prev_date: the date of the previous file processed.
         """
-        self.log.debug(f"Group by {len(self.day_batch)} for daystocks")
-
-        # concat all stocks from this day
-        daystocks = pd.concat(self.day_batch, ignore_index=False)
-
-        # compute relevant daystocks infos through aggregation
-        daystocks = daystocks.groupby(["cid"]).agg(
-            date=pd.NamedAgg(column="value", aggfunc="first"),
-            open=pd.NamedAgg(column="value", aggfunc="first"),
-            close=pd.NamedAgg(column="value", aggfunc="last"),
-            high=pd.NamedAgg(column="value", aggfunc="max"),
-            low=pd.NamedAgg(column="value", aggfunc="min"),
-        )
-        
-        # set the date
-        daystocks["date"] = prev_date
-
-        # add to daystocks batch
-        self.daystocks_batch.append(daystocks)
-        # clear saved stocks from current day
-        self.day_batch = []
+        if self.daystocks:
+            # compute relevant daystocks infos from the accumulated day
+            with self.timer.stage("daystocks"):
+                daystocks = self.day.emit(prev_date)
+            self.timer.count("daystocks", len(daystocks))
+            self.log.debug(f"{len(daystocks)} daystocks")
+
+            # add to daystocks batch
+            self.daystocks_batch.append(daystocks)
+        self.days += 1
+        # runs of stock values end with the day
+        with self.timer.stage("clean"):
+            self.stocks_batch.append(self.compressor.flush(prev_date))
+        # the files of this day are complete once the batch is committed
+        self.files_batch += self.day_files
+        self.day_files = []
 
     def reset_batch(self):
         self.stocks_batch = []
         self.companies_batch = []
         self.daystocks_batch = []
+        self.files_batch = []
+        self.days = 0
+
+    def flush_stocks(self):
+        """
+            Add the held back stocks of every run to the batch,
+            once no more file is to be processed.
+        """
+        self.stocks_batch.append(self.compressor.flush())
 
     def clean_stocks(self, pool_size):
         """
-            Clean the stock batch by removing repeating stock values, so that
-            we store fewer value in database.
+            Gather the stock batch, whose repeating stock values have been
+            removed as files were processed, and split it for the pool.
         """
-        # concat all stocks batchs
-        stocks = pd.concat(self.stocks_batch, ignore_index=False)
-
-        stocks.reset_index(inplace=True)
-        stocks.sort_values(["cid", "date"], inplace=True)
-
-        stocks["day"] = stocks["date"].dt.date
-
-        selected_columns = ["cid", "volume", "value", "day"]
-        # select stocks where there is a change compared to the previous row
-        df1 = stocks[
-            stocks[selected_columns]
-                .ne(stocks[selected_columns]
-                .shift(1))
-                .any(axis=1)
-        ]
-        # select stocks where there is a change compared to the next row
-        df2 = stocks[
-            stocks[selected_columns]
-                .ne(stocks[selected_columns]
-                .shift(-1))
-                .any(axis=1)
-        ]
-        # concat the two df without duplicates
-        stocks = pd.concat([df1, df2.loc[~df2.index.isin(df1.index)]])
-
-        stocks.set_index("cid", drop=True, inplace=True)
-        stocks.drop(columns="day", inplace=True)
-
-        # split clean stocks into batches
-        self.stocks_batch = np.array_split(stocks, pool_size)
+        with self.timer.stage("clean"):
+            # concat all stocks batchs
+            stocks = pd.concat(self.stocks_batch, ignore_index=False)
+
+            # split clean stocks into batches
+            self.stocks_batch = [
+                stocks.iloc[rows] for rows in np.array_split(np.arange(len(stocks)), pool_size)
+            ]
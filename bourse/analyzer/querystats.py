@@ -0,0 +1,130 @@
+import re
+import time
+from bisect import bisect_left
+
+# upper bounds of the latency histogram buckets, in seconds (the last one is open)
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10)
+
+# parts of a query replaced by "?" in its fingerprint
+COMMENTS = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+LITERALS = re.compile(r"'(?:[^']|'')*'|%\(\w+\)s|%s|\$\d+|\b\d+(?:\.\d+)?\b")
+LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+SPACES = re.compile(r"\s+")
+
+
+def fingerprint(query: str) -> str:
+    """
+        Normalize a query so that its executions with different values
+        (literals, placeholders, IN lists) share the same statistics
+        @param query: the text of the query
+    """
+    query = COMMENTS.sub(" ", query)
+    query = LITERALS.sub("?", query)
+    query = LISTS.sub("(?)", query)
+    return SPACES.sub(" ", query).strip()
+
+
+class StatementStats:
+    """
+        The statistics of the executions of a query fingerprint.
+    """
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, seconds: float, rows: int, nbytes: int):
+        self.calls += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.rows += rows
+        self.bytes += nbytes
+        self.histogram[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def percentile(self, fraction: float) -> float:
+        """
+            Return the upper bound of the bucket holding a percentile of the latencies
+            @param fraction: the percentile, between 0 and 1
+        """
+        rank = fraction * self.calls
+        seen = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.histogram):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max_seconds
+
+
+class QueryStats:
+    """
+        The query stats count, by query fingerprint, the calls, latencies,
+        rows and bytes of the statements of a database model.
+        Statements slower than slow_seconds go to the slow query log, and
+        the stats are dumped to the log every dump_seconds.
+    """
+    def __init__(self, log, slow_log=None, slow_seconds=None, dump_seconds=None):
+        """
+            @param log: the logger of the periodic dumps
+            @param slow_log: the logger of the slow queries, log by default
+            @param slow_seconds: the latency of a slow query, None for no slow query log
+            @param dump_seconds: the interval of the dumps, None for no periodic dump
+        """
+        self.log = log
+        self.slow_log = slow_log if slow_log is not None else log
+        self.slow_seconds = slow_seconds
+        self.dump_seconds = dump_seconds
+        self.last_dump = time.monotonic()
+        # fingerprint -> StatementStats
+        self.statements = {}
+        # the same queries are sent again and again, keep their fingerprints
+        self.__fingerprints = {}
+
+    def record(self, query: str, seconds: float, rows: int = 0, nbytes: int = 0):
+        """
+            Add an execution of a statement
+            @param query: the text of the query
+            @param seconds: the latency of the execution
+            @param rows: the number of rows read or written
+            @param nbytes: the number of bytes sent, for COPY
+        """
+        key = self.__fingerprints.get(query)
+        if key is None:
+            key = fingerprint(query)
+            if len(self.__fingerprints) < 10000:
+                self.__fingerprints[query] = key
+        stats = self.statements.get(key)
+        if stats is None:
+            stats = self.statements[key] = StatementStats()
+        stats.add(seconds, rows, nbytes)
+
+        if self.slow_seconds is not None and seconds >= self.slow_seconds:
+            self.slow_log.warning(f"slow query: {seconds:.3f}s {rows} rows: {query[:1000]}")
+        if self.dump_seconds is not None and time.monotonic() - self.last_dump >= self.dump_seconds:
+            self.dump()
+
+    def report(self, limit=20):
+        """
+            Return one line per fingerprint, the most time consuming first
+            @param limit: the number of lines
+        """
+        lines = []
+        ranked = sorted(self.statements.items(), key=lambda item: -item[1].seconds)
+        for key, stats in ranked[:limit]:
+            lines.append(
+                f"{stats.calls:>8} calls {stats.seconds:9.3f}s"
+                f" (p50 <{stats.percentile(0.5) * 1000:g}ms, p99 <{stats.percentile(0.99) * 1000:g}ms,"
+                f" max {stats.max_seconds * 1000:.1f}ms) {stats.rows:>10} rows {stats.bytes:>12} bytes"
+                f": {key[:200]}"
+            )
+        return lines
+
+    def dump(self):
+        """
+            Log the report of the stats
+        """
+        self.last_dump = time.monotonic()
+        for line in self.report():
+            self.log.info(f"SQL stats: {line}")
@@ -0,0 +1,115 @@
+import threading
+from multiprocessing.managers import BaseManager
+
+import numpy as np
+import pandas as pd
+
+
+class CompanyRegistry:
+    """
+        The registry maps company symbols to their id (cid).
+        It is seeded with the companies already stored in the database
+        and gives the next free ids to new companies, so that a restarted
+        analyzer keeps numbering where the database stops.
+        With an allocator, ids of unknown symbols are asked to the allocator
+        instead, so that registries of several processes agree.
+    """
+    def __init__(self, companies: None | pd.DataFrame = None, allocator=None, store=None):
+        """
+            @param companies: the stored companies, with "id" and "symbol" columns
+            @param allocator: a CompanyAllocator (or its proxy) shared between processes
+            @param store: called with the new companies, indexed by their id,
+                          before their ids are given
+        """
+        self.allocator = allocator
+        self.store = store
+        self.next_id = 0
+        # hash index of the known symbols and the cid at each position,
+        # used to map a whole column of symbols at once
+        self.__symbols = pd.Index([], dtype=object)
+        self.__cids = np.empty(0, dtype=np.int64)
+
+        if companies is not None and len(companies) > 0:
+            # a symbol stored twice keeps its first id
+            companies = companies.sort_values("id").drop_duplicates("symbol")
+            self.__add(companies["symbol"].to_numpy(), companies["id"].to_numpy())
+            self.next_id = int(companies["id"].max()) + 1
+
+    def __len__(self):
+        return len(self.__symbols)
+
+    def __add(self, symbols: np.ndarray, cids: np.ndarray):
+        self.__symbols = self.__symbols.append(pd.Index(symbols, dtype=object))
+        self.__cids = np.concatenate([self.__cids, cids.astype(np.int64)])
+
+    def lookup(self, symbols: pd.Series | np.ndarray) -> np.ndarray:
+        """
+            Return the cid of each symbol, -1 for unknown symbols.
+            @param symbols: the symbols to map
+        """
+        positions = self.__symbols.get_indexer(symbols)
+        cids = np.full(len(positions), -1, dtype=np.int64)
+        known = positions >= 0
+        cids[known] = self.__cids[positions[known]]
+        return cids
+
+    def register(self, companies: pd.DataFrame) -> pd.DataFrame:
+        """
+            Give an id to the companies that are not known yet.
+            @param companies: companies with unique symbols
+            @return: the new companies, indexed by their id,
+                     none with an allocator as it stores them itself
+        """
+        new_companies = companies[self.lookup(companies["symbol"]) < 0].reset_index(drop=True)
+        if len(new_companies) == 0:
+            # the index of the known symbols is only rebuilt when it grows
+            new_companies.index.rename("id", inplace=True)
+            return new_companies
+        if self.allocator is not None:
+            self.__add(new_companies["symbol"].to_numpy(), self.allocator.allocate(new_companies))
+            return new_companies.iloc[:0].rename_axis("id")
+
+        new_companies.index += self.next_id
+        new_companies.index.rename("id", inplace=True)
+
+        if self.store is not None:
+            self.store(new_companies)
+        self.__add(new_companies["symbol"].to_numpy(), new_companies.index.to_numpy())
+        self.next_id += len(new_companies)
+        return new_companies
+
+
+class CompanyAllocator:
+    """
+        The allocator gives company ids to the registries of the processes
+        ingesting different markets, so that a symbol gets a single id.
+        It is served by an AllocatorManager.
+        The new companies are stored before their ids are given, so that
+        no market writes stocks of a company missing from the database.
+    """
+    def __init__(self, companies: None | pd.DataFrame = None, store=None):
+        """
+            @param companies: the stored companies, with "id" and "symbol" columns
+            @param store: commits the new companies, indexed by their id
+        """
+        self.registry = CompanyRegistry(companies, store=store)
+        self.lock = threading.Lock()
+
+    def allocate(self, companies: pd.DataFrame) -> np.ndarray:
+        """
+            Give an id to each company.
+            @param companies: companies with unique symbols
+            @return: the id of each company
+        """
+        with self.lock:
+            self.registry.register(companies)
+            return self.registry.lookup(companies["symbol"])
+
+
+class AllocatorManager(BaseManager):
+    """
+        Serve a CompanyAllocator to other processes.
+    """
+
+
+AllocatorManager.register("CompanyAllocator", CompanyAllocator)
@@ -0,0 +1,175 @@
+import argparse
+import json
+import os
+import shutil
+import time
+
+import pandas as pd
+import psycopg2
+
+from commit import connect
+from mylogging import getLogger
+
+log = getLogger(__name__)
+
+# tables of a batch, in load order
+TABLES = ("companies", "stocks", "daystocks")
+
+
+def fsync(path: str):
+    """
+        Flush a file or a directory to the disk
+        @param path: the path of the file or directory
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Spool:
+    """
+        The spool is a directory of processed batches waiting to be loaded
+        into the database: one directory per batch, holding a Parquet file
+        per table and the names of its files.
+        A batch is written in a temporary directory, flushed to the disk and
+        renamed once complete, so the loader never sees a partial batch, even
+        after a crash of the machine, and it stays in
+        the spool until it is loaded: a failed load is replayed from the
+        spool without parsing the files again.
+    """
+    def __init__(self, dir: str):
+        """
+            @param dir: the directory of the spool, created if needed
+        """
+        self.dir = dir
+        os.makedirs(dir, exist_ok=True)
+
+    def write(self, companies: list, stocks: list, daystocks: list, files: list):
+        """
+            Write a batch into the spool
+            @param companies: the dataframes of the companies of the batch
+            @param stocks: the dataframes of the stocks of the batch
+            @param daystocks: the dataframes of the daystocks of the batch
+            @param files: the names of the files of the batch
+            @return: the path of the batch
+        """
+        # names sort in writing order, the pid keeps the markets processes apart
+        name = f"{time.time_ns():020d}-{os.getpid()}"
+        tmp = os.path.join(self.dir, f".{name}.tmp")
+        os.makedirs(tmp)
+        for table, frames in zip(TABLES, (companies, stocks, daystocks)):
+            frames = [df for df in frames if len(df) > 0]
+            if frames:
+                pd.concat(frames).to_parquet(os.path.join(tmp, f"{table}.parquet"))
+                fsync(os.path.join(tmp, f"{table}.parquet"))
+        with open(os.path.join(tmp, "files.json"), "w") as f:
+            json.dump(files, f)
+            f.flush()
+            os.fsync(f.fileno())
+        fsync(tmp)
+        path = os.path.join(self.dir, f"{name}.batch")
+        os.rename(tmp, path)
+        # the rename is durable once the spool directory is flushed
+        fsync(self.dir)
+        return path
+
+    def pending(self):
+        """
+            Return the paths of the complete batches, oldest first
+        """
+        return [
+            os.path.join(self.dir, name)
+            for name in sorted(os.listdir(self.dir))
+            if name.endswith(".batch")
+        ]
+
+    def pending_files(self):
+        """
+            Return the names of the files of the batches not loaded yet
+        """
+        files = set()
+        for path in self.pending():
+            with open(os.path.join(path, "files.json")) as f:
+                files.update(json.load(f))
+        return files
+
+    @staticmethod
+    def read(path: str):
+        """
+            Read a batch
+            @param path: the path of the batch
+            @return: the dataframe of each table of the batch, and the names of its files
+        """
+        tables = {}
+        for table in TABLES:
+            filepath = os.path.join(path, f"{table}.parquet")
+            if os.path.exists(filepath):
+                tables[table] = pd.read_parquet(filepath)
+        with open(os.path.join(path, "files.json")) as f:
+            files = json.load(f)
+        return tables, files
+
+
+def load_batch(db, path: str):
+    """
+        Bulk load a batch of the spool into the database, in one transaction,
+        and remove it from the spool once committed
+        @param db: the database
+        @param path: the path of the batch
+    """
+    tables, files = Spool.read(path)
+    try:
+        db.copy_batch(list(tables.items()), files)
+    except psycopg2.Error:
+        # nothing of the batch is stored, it stays in the spool
+        db.rollback()
+        raise
+    shutil.rmtree(path)
+    return sum(len(df) for df in tables.values())
+
+
+def drain(spool: Spool, db, stop=None, poll_seconds=1.0):
+    """
+        Load the batches of the spool into the database, oldest first
+        @param spool: the spool
+        @param db: the database
+        @param stop: None to return once the spool is empty, or an event: the
+                     spool is polled until the event is set and the spool is empty
+        @param poll_seconds: the interval between two polls of an empty spool
+        @return: the number of batches loaded
+    """
+    loaded = 0
+    while True:
+        # the event is checked before listing, so a batch written
+        # before it was set is always loaded
+        stopping = stop is None or stop.is_set()
+        batches = spool.pending()
+        for path in batches:
+            start = time.perf_counter()
+            rows = load_batch(db, path)
+            loaded += 1
+            log.info(f"{os.path.basename(path)}: {rows} rows loaded in {time.perf_counter() - start:.3f}s")
+        if not batches:
+            if stopping:
+                return loaded
+            time.sleep(poll_seconds)
+
+
+def run_loader(dir: str, stop=None, db_factory=connect):
+    """
+        Drain a spool into the database, the target of the loader process
+        @param dir: the directory of the spool
+        @param stop: see drain
+        @param db_factory: builds the database
+    """
+    loaded = drain(Spool(dir), db_factory(), stop)
+    log.info(f"{loaded} batches loaded from {dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load the batches of a spool into the database")
+    parser.add_argument("dir", help="the directory of the spool")
+    args = parser.parse_args()
+    run_loader(args.dir)
@@ -0,0 +1,44 @@
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class StageTimer:
+    """
+        The timer adds up the wall time spent in each stage of the
+        processing, along with the number of rows the stage handled.
+    """
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.rows = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+            Time the code run in the with block as part of a stage
+            @param name: the name of the stage
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+
+    def count(self, name: str, rows: int):
+        """
+            Add rows to the number of rows handled by a stage
+            @param name: the name of the stage
+            @param rows: the number of rows
+        """
+        self.rows[name] += rows
+
+    def report(self):
+        """
+            Return one line per stage with its wall time and throughput
+        """
+        lines = []
+        for name, seconds in self.seconds.items():
+            rows = self.rows[name]
+            rate = rows / seconds if seconds else 0
+            lines.append(f"{name:>10}: {seconds:9.3f}s {rows:>12} rows {rate:>12.0f} rows/s")
+        return lines
@@ -4,22 +4,157 @@
 # pipenv install sqlalchemy-timescaledb
 
 import datetime
+import io
+import itertools
+import sys
+import time
+import numpy as np
 import psycopg2
 import pandas as pd
 import sqlalchemy
 
 import mylogging
+from querystats import QueryStats
+
+# Postgres type OIDs (see pg_type) handled by df_copy
+BOOL_OID, INT8_OID, INT2_OID, INT4_OID = 16, 20, 21, 23
+FLOAT4_OID, FLOAT8_OID = 700, 701
+DATE_OID, TIMESTAMP_OID, TIMESTAMPTZ_OID = 1082, 1114, 1184
+
+# binary COPY encoding of fixed width types, big endian
+BINARY_FORMATS = {
+    BOOL_OID: '?',
+    INT2_OID: '>i2',
+    INT4_OID: '>i4',
+    INT8_OID: '>i8',
+    FLOAT4_OID: '>f4',
+    FLOAT8_OID: '>f8',
+    DATE_OID: '>i4',
+    TIMESTAMP_OID: '>i8',
+    TIMESTAMPTZ_OID: '>i8',
+}
+INTEGER_OIDS = (INT2_OID, INT4_OID, INT8_OID)
+FLOAT_OIDS = (FLOAT4_OID, FLOAT8_OID)
+TIME_OIDS = (TIMESTAMP_OID, TIMESTAMPTZ_OID)
+
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + np.zeros(2, '>i4').tobytes()
+PGCOPY_TRAILER = np.array([-1], '>i2').tobytes()
+PG_EPOCH = np.datetime64('2000-01-01T00:00:00', 'us')
+
+# numpy type of the columns of a result, by type oid (object otherwise)
+NUMPY_DTYPES = {
+    BOOL_OID: np.bool_,
+    INT2_OID: np.int16,
+    INT4_OID: np.int32,
+    INT8_OID: np.int64,
+    FLOAT4_OID: np.float32,
+    FLOAT8_OID: np.float64,
+    DATE_OID: 'datetime64[D]',
+    TIMESTAMP_OID: 'datetime64[us]',
+    TIMESTAMPTZ_OID: 'datetime64[us]',
+}
+
+# names of the server side cursors
+cursor_names = itertools.count()
+
+# (id, name, alias) of the known markets
+MARKETS = [
+    (1, 'NYSE Euronext', 'euronx'),
+    (2, 'London Stock Exchange', 'lse'),
+    (3, 'Bourse Italienne', 'milano'),
+    (4, 'Bourse Allemande', 'dbx'),
+    (5, 'Bourse Espagnole', 'mercados'),
+    (6, 'Amsterdam', 'amsterdam'),
+    (7, 'Paris compartiment A', 'compA'),
+    (8, 'Paris compartiment B', 'compB'),
+    (9, 'Bourse Allemande', 'xetra'),
+    (10, 'Bruxelle', 'bruxelle'),
+    (11, 'PEA-PME', 'peapme'),
+]
+
+# chunk interval of each hypertable: a week of ticks of every company, with
+# its indexes, stays well within the memory of the database, and daystocks
+# are a few thousand rows a day
+CHUNK_INTERVALS = {
+    'stocks': '7 days',
+    'daystocks': '182 days',
+}
+
+# secondary indexes, dropped during a backfill and built again at its end
+INDEXES = {
+    'idx_cid_stocks': 'CREATE INDEX IF NOT EXISTS idx_cid_stocks ON stocks (cid, date DESC);',
+    'idx_cid_daystocks': 'CREATE INDEX IF NOT EXISTS idx_cid_daystocks ON daystocks (cid, date DESC);',
+    'idx_name_companies': 'CREATE INDEX IF NOT EXISTS idx_name_companies ON companies USING gin (name gin_trgm_ops);',
+}
+
+# (id, rank) of the companies whose name contains %(name)s ignoring case,
+# the trigram index serves the ILIKE filter
+SEARCH_COMPANY_QUERY = '''
+    SELECT id, CASE WHEN name = %(name)s THEN 0
+                    WHEN LOWER(name) LIKE LOWER(%(name)s) THEN 1
+                    WHEN name LIKE %(name)s || '%%' THEN 2
+                    WHEN name LIKE '%%' || %(name)s || '%%' THEN 3
+                    ELSE 4 END AS rank
+    FROM companies
+    WHERE name ILIKE '%%' || %(name)s || '%%'
+    ORDER BY rank, similarity(name, %(name)s) DESC, id
+    LIMIT %(limit)s'''
+
+# statements prepared on the connection of the model when first executed,
+# name: (types of the parameters, query with $n parameters)
+PREPARED_STATEMENTS = {
+    'market_id': ('varchar', 'SELECT id FROM markets WHERE alias = $1'),
+    'is_file_done': ('varchar', 'SELECT EXISTS (SELECT 1 FROM file_done WHERE name = $1)'),
+}
+
+# tables a backfill can load into UNLOGGED <table>_staging tables first
+STAGED_TABLES = ('stocks', 'daystocks', 'file_done')
+
+# OHLCV of a bucket, from the ticks of stocks or from coarser bars
+# (daystocks, or another aggregate). Volumes are cumulative over a session.
+TICK_BARS = '''first(value, date) FILTER (WHERE value IS NOT NULL) AS open,
+               last(value, date) FILTER (WHERE value IS NOT NULL) AS close,
+               max(value) AS high, min(value) AS low, max(volume) AS volume'''
+BAR_BARS = '''first(open, date) AS open, last(close, date) AS close,
+              max(high) AS high, min(low) AS low, sum(volume) AS volume'''
+
+# continuous aggregates by source of the daily bars, in refresh order:
+# (view, source, bucket, refresh start offset, refresh end offset, schedule interval)
+AGGREGATES = {
+    'stocks': [
+        ('stocks_daily', 'stocks', '1 day', '3 days', '1 hour', '1 hour'),
+        ('stocks_weekly', 'stocks_daily', '1 week', '1 month', '1 day', '1 day'),
+        ('stocks_monthly', 'stocks_daily', '1 month', '3 months', '1 day', '1 day'),
+    ],
+    'daystocks': [
+        ('daystocks_weekly', 'daystocks', '1 week', '1 month', '1 day', '1 day'),
+        ('daystocks_monthly', 'daystocks', '1 month', '3 months', '1 day', '1 day'),
+    ],
+}
+
 
 class TimescaleStockMarketModel:
     """ Bourse model with TimeScaleDB persistence."""
 
-    def __init__(self, database, user=None, host=None, password=None, port=None):
+    def __init__(self, database, user=None, host=None, password=None, port=None,
+                 pool_size=2, max_overflow=2, pool_timeout=30, pool_recycle=3600,
+                 query_stats=False, slow_query_seconds=None, stats_dump_seconds=None):
         """Create a TimescaleStockMarketModel
 
         database -- The name of the persistence database.
         user     -- Username to connect with to the database. Same as the
                     database name by default.
+        pool_size, max_overflow, pool_timeout, pool_recycle -- Limits of the
+                    connection pool, see sqlalchemy.create_engine. The model
+                    holds one connection of the pool, pandas queries use the others.
+        query_stats -- Count the calls, latency, rows and bytes of each query
+                    fingerprint in self.query_stats. Off, it costs a test per query.
+        slow_query_seconds -- With query_stats, log the queries slower than this
+                    to /tmp/bourse-slow.log.
+        stats_dump_seconds -- With query_stats, log the stats at this interval.
 
+        Nothing is connected until the database is used, and the schema is
+        not created: call setup_database once per deployment.
         """
 
         self.logger = mylogging.getLogger(__name__, filename="/tmp/bourse.log")
@@ -29,33 +164,73 @@ class TimescaleStockMarketModel:
         self.__host = host or 'localhost'
         self.__port = port or 5432
         self.__password = password or ''
+        self.__pool_options = dict(pool_size=pool_size, max_overflow=max_overflow,
+                                   pool_timeout=pool_timeout, pool_recycle=pool_recycle,
+                                   pool_pre_ping=True)
         self.__squash = False
-        self.__connection = psycopg2.connect(database=self.__database,
-                                             user=self.__user,
-                                             host=self.__host,
-                                             password=self.__password)
-        self.__engine = sqlalchemy.create_engine(f'timescaledb://{self.__user}:{self.__password}@{self.__host}:{self.__port}/{self.__database}')
+        self.__engine = None  # created when first used
+        self.__connection = None  # psycopg2 connection checked out of the engine pool
+        self.__statements = dict(PREPARED_STATEMENTS)  # statements that can be prepared
+        self.__prepared = set()  # names of the statements prepared on the connection
+        self.__column_types = {}  # (name, type oid) of the columns of a table
+        self.query_stats = None
+        if query_stats:
+            self.query_stats = QueryStats(
+                self.logger,
+                mylogging.getLogger(__name__ + '.slow', filename='/tmp/bourse-slow.log'),
+                slow_query_seconds, stats_dump_seconds)
         self.__nf_cid = {}  # cid from netfonds symbol
         self.__boursorama_cid = {}  # cid from netfonds symbol
         self.__market_id = {}  # id of markets from aliases
 
-        self.logger.info("Setup database generates an error if it exists already, it's ok")
-        self._setup_database()
+    def _engine(self):
+        '''Return the engine of the model, creating its connection pool when first called'''
+        if self.__engine is None:
+            self.__engine = sqlalchemy.create_engine(
+                f'timescaledb://{self.__user}:{self.__password}@{self.__host}:{self.__port}/{self.__database}',
+                **self.__pool_options)
+        return self.__engine
+
+    def _connection(self):
+        '''Return the psycopg2 connection of the model, checked out of the engine pool'''
+        if self.__connection is None:
+            self.__connection = self._engine().raw_connection()
+            self.__prepared = set()
+        return self.__connection
+
+    def close(self):
+        '''Give the connection back to the pool and close the pool'''
+        if self.__connection is not None:
+            self.__connection.close()
+            self.__connection = None
+        if self.__engine is not None:
+            self.__engine.dispose()
+            self.__engine = None
+
+    def setup_database(self, aggregates=None, compress_after=None):
+        '''Create the schema if it does not exist, and insert the known markets.
+
+        Every statement is idempotent, so it can run on an existing database.
 
+        :param aggregates: None, or the source of the daily bars to create the
+                           continuous aggregates of: 'stocks' builds daily, weekly
+                           and monthly bars from the ticks (daystocks are then not
+                           needed), 'daystocks' builds weekly and monthly bars
+                           from the daystocks computed by the analyzer
+        :param compress_after: None, or the age (an interval such as '30 days')
+                               after which the chunks of the hypertables are
+                               compressed by a policy
 
-    def _setup_database(self):
+        To drop all tables (clean) do
+          drop schema public cascade;
+          create schema public;
+        '''
+        cursor = self._connection().cursor()
         try:
-            # Create the tables if they do not exist.
-            #
-            # To drop all tables (clean) do
-            #   drop schema public cascade;
-            #   create schema public;
-            #
-            cursor = self.__connection.cursor()
             # markets (see end for list of makets)
-            cursor.execute('''CREATE SEQUENCE market_id_seq START 1;''')
+            cursor.execute('''CREATE SEQUENCE IF NOT EXISTS market_id_seq START 1;''')
             cursor.execute(
-                '''CREATE TABLE markets (
+                '''CREATE TABLE IF NOT EXISTS markets (
                   id SMALLINT PRIMARY KEY DEFAULT nextval('market_id_seq'),
                   name VARCHAR,
                   alias VARCHAR
@@ -63,9 +238,9 @@ class TimescaleStockMarketModel:
             # company:
             #   - mid : market id
             #
-            cursor.execute('''CREATE SEQUENCE company_id_seq START 1;''')
+            cursor.execute('''CREATE SEQUENCE IF NOT EXISTS company_id_seq START 1;''')
             cursor.execute(
-                '''CREATE TABLE companies (
+                '''CREATE TABLE IF NOT EXISTS companies (
                   id SMALLINT PRIMARY KEY DEFAULT nextval('company_id_seq'),
                   name VARCHAR,
                   mid SMALLINT,
@@ -77,17 +252,21 @@ class TimescaleStockMarketModel:
                   pea BOOLEAN,
                   sector INTEGER
                 );''')
+            cursor.execute('''CREATE EXTENSION IF NOT EXISTS pg_trgm;''')
+            cursor.execute(INDEXES['idx_name_companies'])
             cursor.execute(
-                '''CREATE TABLE stocks (
+                '''CREATE TABLE IF NOT EXISTS stocks (
                   date TIMESTAMPTZ,
                   cid SMALLINT,
                   value FLOAT4,
                   volume INT
                 );''')
-            cursor.execute('''SELECT create_hypertable('stocks', by_range('date'));''')
-            cursor.execute('''CREATE INDEX idx_cid_stocks ON stocks (cid, date DESC);''')
+            cursor.execute('''SELECT create_hypertable('stocks', by_range('date', %s::interval),
+                                                       if_not_exists => TRUE);''',
+                           (CHUNK_INTERVALS['stocks'],))
+            cursor.execute(INDEXES['idx_cid_stocks'])
             cursor.execute(
-                '''CREATE TABLE daystocks (
+                '''CREATE TABLE IF NOT EXISTS daystocks (
                   date TIMESTAMPTZ,
                   cid SMALLINT,
                   open FLOAT4,
@@ -96,32 +275,151 @@ class TimescaleStockMarketModel:
                   low FLOAT4,
                   volume INT
                 );''')
-            cursor.execute('''SELECT create_hypertable('daystocks', by_range('date'));''')
-            cursor.execute('''CREATE INDEX idx_cid_daystocks ON daystocks (cid, date DESC);''')
+            cursor.execute('''SELECT create_hypertable('daystocks', by_range('date', %s::interval),
+                                                       if_not_exists => TRUE);''',
+                           (CHUNK_INTERVALS['daystocks'],))
+            cursor.execute(INDEXES['idx_cid_daystocks'])
             cursor.execute(
-                '''CREATE TABLE file_done (
+                '''CREATE TABLE IF NOT EXISTS file_done (
                   name VARCHAR PRIMARY KEY
                 );''')
             cursor.execute(
-                '''CREATE TABLE tags (
+                '''CREATE TABLE IF NOT EXISTS tags (
                   name VARCHAR PRIMARY KEY,
                   value VARCHAR
                 );''')
             # let insert known market
-            cursor.execute("INSERT INTO markets (id, name, alias) VALUES (1,'NYSE Euronext','euronx');")
-            cursor.execute("INSERT INTO markets (id, name, alias) VALUES (2,'London Stock Exchange','lse');")
-            cursor.execute("INSERT INTO markets (id, name, alias) VALUES (3,'Bourse Italienne','milano');")
-            cursor.execute("INSERT INTO markets (id, name, alias) VALUES (4,'Bourse Allemande','dbx');")
-            cursor.execute("INSERT INTO markets (id, name, alias) VALUES (5,'Bourse Espagnole','mercados');")
-            cursor.execute("INSERT INTO markets (id, name, alias) VALUES (6,'Amsterdam','amsterdam');")
-            cursor.execute("INSERT INTO markets (id, name, alias) VALUES (7,'Paris compartiment A','compA');")
-            cursor.execute("INSERT INTO markets (id, name, alias) VALUES (8,'Paris compartiment B','compB');")
-            cursor.execute("INSERT INTO markets (id, name, alias) VALUES (9,'Bourse Allemande','xetra');")
-            cursor.execute("INSERT INTO markets (id, name, alias) VALUES (10,'Bruxelle','bruxelle');")
-            cursor.execute("INSERT INTO markets (id, name, alias) VALUES (11,'PEA-PME','peapme');")
+            cursor.executemany('''INSERT INTO markets (id, name, alias) VALUES (%s, %s, %s)
+                                  ON CONFLICT (id) DO NOTHING;''', MARKETS)
+            for table, interval in CHUNK_INTERVALS.items():
+                # tables created before get the interval for their new chunks
+                cursor.execute('SELECT set_chunk_time_interval(%s, %s::interval);', (table, interval))
+                self._enable_compression(cursor, table, compress_after)
+            for aggregate in AGGREGATES.get(aggregates, []):
+                self._create_aggregate(cursor, *aggregate)
         except Exception as e:
             self.logger.exception('SQL error: %s' % e)
-        self.__connection.commit()
+            self.rollback()
+            raise
+        self.commit()
+
+    def _enable_compression(self, cursor, table, compress_after=None):
+        '''Compress the chunks of a hypertable by cid, newest rows first'''
+        cursor.execute('''SELECT compression_enabled FROM timescaledb_information.hypertables
+                          WHERE hypertable_name = %s;''', (table,))
+        # settings can not change once chunks are compressed
+        if not cursor.fetchone()[0]:
+            cursor.execute(f'''ALTER TABLE {table} SET (timescaledb.compress,
+                                   timescaledb.compress_segmentby = 'cid',
+                                   timescaledb.compress_orderby = 'date DESC');''')
+        if compress_after is not None:
+            cursor.execute('''SELECT add_compression_policy(%s, compress_after => %s::interval,
+                                                            if_not_exists => TRUE);''',
+                           (table, compress_after))
+
+    def _create_aggregate(self, cursor, view, source, bucket, start, end, schedule):
+        '''Create a continuous aggregate of OHLCV bars and its refresh policy'''
+        bars = TICK_BARS if source == 'stocks' else BAR_BARS
+        cursor.execute(
+            f'''CREATE MATERIALIZED VIEW IF NOT EXISTS {view}
+                WITH (timescaledb.continuous) AS
+                SELECT time_bucket('{bucket}', date) AS date, cid, {bars}
+                FROM {source}
+                GROUP BY 1, cid
+                WITH NO DATA;''')
+        cursor.execute('''SELECT add_continuous_aggregate_policy(%s,
+                              start_offset => %s::interval, end_offset => %s::interval,
+                              schedule_interval => %s::interval, if_not_exists => TRUE);''',
+                       (view, start, end, schedule))
+
+    def refresh_aggregates(self, start=None, end=None):
+        '''Refresh the continuous aggregates of the database, coarser ones last.
+
+        Policies only refresh recent buckets: call this after loading older data.
+        Only the buckets invalidated by new rows are computed again.
+
+        :param start: the start of the window to refresh, None for the beginning
+        :param end: the end of the window to refresh, None for now
+        '''
+        views = {row[0] for row in self.raw_query(
+            'SELECT view_name FROM timescaledb_information.continuous_aggregates')}
+        self.commit()
+        # refresh_continuous_aggregate can not run in a transaction
+        connection = self._connection().dbapi_connection
+        connection.autocommit = True
+        try:
+            for view, *_ in AGGREGATES['stocks'] + AGGREGATES['daystocks']:
+                if view in views:
+                    self.logger.info('refreshing %s' % view)
+                    self.execute('CALL refresh_continuous_aggregate(%s, %s, %s)', (view, start, end))
+        finally:
+            connection.autocommit = False
+
+    def drop_indexes(self):
+        '''Drop the secondary indexes, so that a backfill does not maintain them'''
+        for index in INDEXES:
+            self.execute('DROP INDEX IF EXISTS %s;' % index)
+        self.commit()
+
+    def create_indexes(self):
+        '''Build the secondary indexes that do not exist, each in one pass'''
+        for index, query in INDEXES.items():
+            start = time.perf_counter()
+            self.execute(query, commit=True)
+            self.logger.info('%s built in %.1fs' % (index, time.perf_counter() - start))
+
+    def create_staging_tables(self):
+        '''Create empty UNLOGGED copies of the staged tables, named <table>_staging.
+
+        Writes to them skip the WAL, and their content is lost if the database
+        crashes: files are recorded in file_done_staging until the merge, so that
+        they are processed again.
+        '''
+        for table in STAGED_TABLES:
+            # leftovers of an interrupted backfill are not in file_done, drop them
+            self.execute('DROP TABLE IF EXISTS %s_staging;' % table)
+            self.execute('CREATE UNLOGGED TABLE %s_staging (LIKE %s INCLUDING DEFAULTS);' % (table, table))
+        self.commit()
+
+    def merge_staging_tables(self):
+        '''Move the staging tables into their tables in one transaction, and drop them'''
+        start = time.perf_counter()
+        for table in STAGED_TABLES:
+            if table == 'file_done':
+                self.execute('INSERT INTO file_done SELECT DISTINCT * FROM file_done_staging '
+                             'ON CONFLICT DO NOTHING;')
+            else:
+                self.execute('INSERT INTO %s SELECT * FROM %s_staging;' % (table, table))
+            self.execute('DROP TABLE %s_staging;' % table)
+        self.commit()
+        self.logger.info('staging tables merged in %.1fs' % (time.perf_counter() - start))
+
+    def storage_sizes(self):
+        '''Return the size in bytes of each hypertable, indexes and compressed chunks included'''
+        return dict(self.raw_query(
+            '''SELECT hypertable_name,
+                      hypertable_size(format('%I.%I', hypertable_schema, hypertable_name)::regclass)
+               FROM timescaledb_information.hypertables'''))
+
+    def compress_chunks(self, table, older_than=None):
+        '''Compress the chunks of a hypertable, one transaction per chunk.
+
+        :param table: the name of the hypertable
+        :param older_than: None for every chunk, or an interval such as '7 days'
+        :return: the number of chunks compressed
+        '''
+        chunks = self.raw_query(
+            '''SELECT format('%%I.%%I', chunk_schema, chunk_name)
+               FROM timescaledb_information.chunks
+               WHERE hypertable_name = %s AND NOT is_compressed
+                 AND (%s::interval IS NULL OR range_end < now() - %s::interval)
+               ORDER BY range_start''', (table, older_than, older_than))
+        self.commit()
+        for (chunk,) in chunks:
+            start = time.perf_counter()
+            self.execute('SELECT compress_chunk(%s::regclass)', (chunk,), commit=True)
+            self.logger.info('%s compressed in %.1fs' % (chunk, time.perf_counter() - start))
+        return len(chunks)
 
     # ------------------------------ public methods --------------------------------
 
@@ -133,8 +431,11 @@ class TimescaleStockMarketModel:
             pretty = '%s %% %r' % (query, args)
         self.logger.debug('SQL: QUERY: %s' % pretty)
         if cursor is None:
-            cursor = self.__connection.cursor()
+            cursor = self._connection().cursor()
+        start = time.perf_counter()
         cursor.execute(query, args)
+        if self.query_stats is not None:
+            self._record(query, start, max(cursor.rowcount, 0))
         if commit:
             self.commit()
         try:
@@ -144,20 +445,182 @@ class TimescaleStockMarketModel:
 
     def df_write(self, df, table, args=None, commit=False,
                  if_exists='append', index=True, index_label=None,
-                 chunksize=1000, dtype=None, method="multi"):
+                 chunksize=1000, dtype=None, method="multi", con=None):
         '''Write a Pandas dataframe to the Postgres SQL database
 
         :param query:
         :param args: arguments for the query
         :param commit: do a commit after writing
+        :param con: a sqlalchemy connection to write in its transaction,
+                    the engine of the model by default
         :param other args: see https://pandas.pydata.org/pandas-docs/stable/reference/api/pandas.to_sql.html
         '''
         self.logger.debug('df_write')
-        df.to_sql(table, self.__engine,
+        start = time.perf_counter()
+        df.to_sql(table, con if con is not None else self._engine(),
                   if_exists=if_exists, index=index, index_label=index_label,
                   chunksize=chunksize, dtype=dtype, method=method)
+        if self.query_stats is not None:
+            self._record('INSERT INTO %s (to_sql)' % table, start, len(df))
         if commit:
             self.commit()
+        self._log_throughput('df_write', table, len(df), start)
+
+    def df_copy(self, df, table, format='binary', index=True, index_label=None, commit=True):
+        '''Bulk load a Pandas dataframe into an existing table with COPY FROM STDIN
+
+        The COPY buffer is built column by column with numpy, no Python object
+        is created per row. Naive timestamps are stored as UTC.
+
+        :param df: the dataframe to write, its columns must exist in the table
+        :param table: the name of the table
+        :param format: 'binary' or 'text'. Frames with missing values or
+                       columns of variable width (strings) are always sent as text
+        :param index: write the index as a column, like df_write
+        :param index_label: column name of the index (default: index name)
+        :param commit: do a commit after writing
+        '''
+        start = time.perf_counter()
+        if index:
+            df = df.reset_index()
+            if index_label is not None:
+                df.rename(columns={df.columns[0]: index_label}, inplace=True)
+        if len(df) == 0:
+            return
+        types = dict(self._column_types(table))
+        oids = [types[column] for column in df.columns]
+        if format == 'binary' and not self._binary_copyable(df, oids):
+            self.logger.debug('df_copy: %s can not be sent as binary, using text' % table)
+            format = 'text'
+        if format == 'binary':
+            payload = self._binary_copy_buffer(df, oids)
+        else:
+            payload = self._text_copy_buffer(df, oids)
+
+        columns = ', '.join('"%s"' % column for column in df.columns)
+        query = 'COPY %s (%s) FROM STDIN WITH (FORMAT %s)' % (table, columns, format)
+        self.logger.debug('SQL: QUERY: %s' % query)
+        cursor = self._connection().cursor()
+        copy_start = time.perf_counter()
+        cursor.copy_expert(query, io.BytesIO(payload))
+        if self.query_stats is not None:
+            self._record(query, copy_start, len(df), len(payload))
+        if commit:
+            self.commit()
+        self._log_throughput('df_copy', table, len(df), start)
+
+    def copy_batch(self, frames, files, table='file_done'):
+        '''Bulk load the dataframes of a batch and mark its files as done, in one
+        transaction: either the batch and its files are stored, or nothing is.
+        On error the caller rolls back.
+
+        :param frames: the (table, dataframe) pairs of the batch
+        :param files: the names of the files of the batch
+        :param table: the table of the names of the files
+        '''
+        for frame_table, df in frames:
+            self.df_copy(df, frame_table, commit=False)
+        if files:
+            self.add_files_done(files, commit=False, table=table)
+        self.commit()
+
+    def df_write_batch(self, frames, files, table='file_done'):
+        '''Like copy_batch, with to_sql, in one transaction of a connection of the pool'''
+        with self._engine().begin() as con:
+            for frame_table, df in frames:
+                self.df_write(df, frame_table, con=con)
+            if files:
+                con.exec_driver_sql(
+                    'INSERT INTO ' + table + ' (name) SELECT unnest(%(names)s) ON CONFLICT DO NOTHING',
+                    {'names': list(files)})
+
+    def _column_types(self, table):
+        '''Return the (name, type oid) of the columns of a table'''
+        if table not in self.__column_types:
+            cursor = self._connection().cursor()
+            cursor.execute('SELECT * FROM %s LIMIT 0' % table)
+            self.__column_types[table] = [(c.name, c.type_code) for c in cursor.description]
+        return self.__column_types[table]
+
+    @staticmethod
+    def _binary_copyable(df, oids):
+        '''Whether a frame can be sent as binary: fixed width types, no missing
+        value, and integers within the width of their column. Out of range
+        integers would silently wrap in the binary buffer, the text COPY lets
+        Postgres reject them.'''
+        if not all(oid in BINARY_FORMATS for oid in oids) or df.isna().to_numpy().any():
+            return False
+        for name, oid in zip(df.columns, oids):
+            if oid in INTEGER_OIDS and len(df):
+                info = np.iinfo(BINARY_FORMATS[oid])
+                values = df[name].to_numpy()
+                if values.min() < info.min or values.max() > info.max:
+                    return False
+        return True
+
+    @staticmethod
+    def _time_values(column, oid):
+        '''Return a datetime64[us] array of a column, in UTC for time types'''
+        times = pd.to_datetime(column)
+        if times.dt.tz is not None:
+            times = times.dt.tz_convert('UTC').dt.tz_localize(None)
+        values = times.to_numpy().astype('datetime64[us]')
+        if oid == DATE_OID:
+            values = values.astype('datetime64[D]')
+        return values
+
+    def _binary_copy_buffer(self, df, oids):
+        '''Build a binary COPY buffer, each row being a fixed width record'''
+        fields = [('nfields', '>i2')]
+        for i, oid in enumerate(oids):
+            fields += [('len%d' % i, '>i4'), ('val%d' % i, BINARY_FORMATS[oid])]
+        rows = np.empty(len(df), dtype=np.dtype(fields))
+        rows['nfields'] = len(oids)
+        for i, (name, oid) in enumerate(zip(df.columns, oids)):
+            column = df[name]
+            if oid in TIME_OIDS or oid == DATE_OID:
+                times = self._time_values(column, oid)
+                values = (times - PG_EPOCH.astype(times.dtype)).astype(np.int64)
+            else:
+                values = column.to_numpy()
+            rows['len%d' % i] = np.dtype(BINARY_FORMATS[oid]).itemsize
+            rows['val%d' % i] = values
+        return PGCOPY_HEADER + rows.tobytes() + PGCOPY_TRAILER
+
+    def _text_copy_buffer(self, df, oids):
+        '''Build a text COPY buffer by concatenating the columns as numpy strings'''
+        lines = None
+        for name, oid in zip(df.columns, oids):
+            column = df[name]
+            missing = column.isna().to_numpy()
+            if oid in TIME_OIDS or oid == DATE_OID:
+                values = self._time_values(column.where(~missing, PG_EPOCH), oid).astype(str)
+                if oid == TIMESTAMPTZ_OID:
+                    values = np.char.add(values, '+00')
+            elif oid in INTEGER_OIDS:
+                values = np.where(missing, 0, column.to_numpy()).astype(np.int64).astype(str)
+            elif oid in FLOAT_OIDS:
+                values = np.where(missing, 0, column.to_numpy()).astype(np.float64).astype(str)
+            elif oid == BOOL_OID:
+                values = np.where(column.to_numpy() == True, 't', 'f')
+            else:
+                values = column.to_numpy().astype(str)
+                for char, escaped in (('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r')):
+                    values = np.char.replace(values, char, escaped)
+            values = np.where(missing, '\\N', values)
+            lines = values if lines is None else np.char.add(np.char.add(lines, '\t'), values)
+        lines = np.char.add(lines, '\n')
+        # numpy strings are fixed width UCS4, drop the padding in one pass
+        encoding = 'utf-32-le' if sys.byteorder == 'little' else 'utf-32-be'
+        return lines.tobytes().decode(encoding).replace('\x00', '').encode('utf-8')
+
+    def _record(self, query, start, rows=0, nbytes=0):
+        self.query_stats.record(query, time.perf_counter() - start, rows, nbytes)
+
+    def _log_throughput(self, method, table, rows, start):
+        elapsed = time.perf_counter() - start
+        self.logger.info('%s %s: %d rows in %.3fs (%.0f rows/s)'
+                         % (method, table, rows, elapsed, rows / elapsed if elapsed else 0))
 
     # general query methods
 
@@ -168,10 +631,16 @@ class TimescaleStockMarketModel:
         else:
             pretty = '%s %% %r' % (query, args)
         self.logger.debug('SQL: QUERY: %s' % pretty)
+        idle = self._idle()
         if cursor is None:
-            cursor = self.__connection.cursor()
+            cursor = self._connection().cursor()
+        start = time.perf_counter()
         cursor.execute(query, args)
-        return cursor.fetchall()
+        rows = cursor.fetchall()
+        if self.query_stats is not None:
+            self._record(query, start, len(rows))
+        self._end_read(idle)
+        return rows
 
     def df_query(self, query, args=None, index_col=None, coerce_float=True, params=None, 
                  parse_dates=None, columns=None, chunksize=1000, dtype=None):
@@ -185,28 +654,187 @@ class TimescaleStockMarketModel:
         if args is not None:
             query = query % args
         self.logger.debug('df_query: %s' % query)
-        return pd.read_sql(query, self.__engine, index_col=index_col, coerce_float=coerce_float, 
-                           params=params, parse_dates=parse_dates, columns=columns, 
-                           chunksize=chunksize, dtype=dtype)
+        start = time.perf_counter()
+        result = pd.read_sql(query, self._engine(), index_col=index_col, coerce_float=coerce_float,
+                             params=params, parse_dates=parse_dates, columns=columns,
+                             chunksize=chunksize, dtype=dtype)
+        if self.query_stats is None:
+            return result
+        if chunksize is None:
+            self._record(query, start, len(result))
+            return result
+        return self._recorded_chunks(query, start, result)
+
+    def _recorded_chunks(self, query, start, chunks):
+        '''Yield the chunks of a df_query, and record the query once they are read'''
+        rows = 0
+        for chunk in chunks:
+            rows += len(chunk)
+            yield chunk
+        self._record(query, start, rows)
+
+    def iter_arrays(self, query, args=None, batch_size=100000):
+        '''Run a query with a server side cursor and yield its rows by batches
+
+        Each batch is a dict of numpy arrays, one per column. Only one batch is
+        held client side at a time. Integers and booleans with NULL become
+        float64 with NaN, timestamps are UTC datetime64[us].
+
+        :param query: the query, with %s placeholders for args
+        :param args: arguments for the query
+        :param batch_size: the number of rows fetched at once
+        '''
+        self.logger.debug('iter_arrays: %s' % query)
+        idle = self._idle()
+        cursor = self._connection().cursor('iter_arrays_%d' % next(cursor_names))
+        cursor.itersize = batch_size
+        start = time.perf_counter()
+        fetched = 0
+        try:
+            cursor.execute(query, args)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                fetched += len(rows)
+                yield {column.name: self._column_array(values, column.type_code)
+                       for column, values in zip(cursor.description, zip(*rows))}
+        finally:
+            cursor.close()
+            self._end_read(idle)
+            if self.query_stats is not None:
+                # the time the caller spends on the batches is included
+                self._record(query, start, fetched)
+
+    def _idle(self):
+        '''Whether the connection of the model is out of any transaction'''
+        return (self.__connection is None
+                or self.__connection.dbapi_connection.info.transaction_status
+                == psycopg2.extensions.TRANSACTION_STATUS_IDLE)
+
+    def _end_read(self, idle):
+        '''End the transaction opened by a read when the connection was idle before it,
+        so that the connection does not stay idle in transaction, which holds
+        back autovacuum and the compression jobs of the hypertables.
+        A transaction of the caller is left open.'''
+        if idle and self.__connection is not None:
+            self.__connection.commit()
+
+    @staticmethod
+    def _column_array(values, oid):
+        '''Convert the values of a column, as fetched, to a numpy array'''
+        dtype = NUMPY_DTYPES.get(oid, object)
+        if oid in TIME_OIDS or oid == DATE_OID:
+            # NULL values become NaT
+            times = pd.to_datetime(pd.Series(values, dtype=object), utc=oid == TIMESTAMPTZ_OID)
+            if times.dt.tz is not None:
+                times = times.dt.tz_localize(None)
+            return times.to_numpy().astype(dtype)
+        if dtype is not object and None in values:
+            if oid in INTEGER_OIDS or oid == BOOL_OID:
+                dtype = np.float64
+            values = [np.nan if value is None else value for value in values]
+        return np.array(values, dtype=dtype)
+
+    def query_arrays(self, query, args=None, batch_size=100000, rows=None):
+        '''Return the result of a query as one numpy array per column
+
+        The arrays are filled batch by batch from iter_arrays, and doubled when
+        full: a multi-million-row read holds the result and a single batch, not
+        a list of frames to concatenate, and the query runs once.
+
+        :param query: the query, with %s placeholders for args
+        :param args: arguments for the query
+        :param batch_size: the number of rows fetched at once
+        :param rows: the expected number of rows of the result, to allocate the arrays once
+        :return: a dict of numpy arrays, empty if the result is empty
+        '''
+        if rows is None:
+            rows = batch_size
+        arrays = {}
+        filled = 0
+        for batch in self.iter_arrays(query, args, batch_size):
+            size = len(next(iter(batch.values())))
+            if filled + size > rows:
+                rows = max(2 * rows, filled + size)
+                arrays = {name: np.resize(array, rows) for name, array in arrays.items()}
+            for name, values in batch.items():
+                if name not in arrays:
+                    arrays[name] = np.empty(rows, dtype=values.dtype)
+                elif not np.can_cast(values.dtype, arrays[name].dtype):
+                    # NULL values in a column of integers
+                    arrays[name] = arrays[name].astype(np.result_type(values.dtype, arrays[name].dtype))
+                arrays[name][filled:filled + size] = values
+            filled += size
+        return {name: array[:filled] for name, array in arrays.items()}
+
+    def prepare(self, name, types, query):
+        '''Register a statement, prepared on the connection when first executed
+
+        :param name: the name of the statement
+        :param types: the types of the parameters, comma separated
+        :param query: the query, with $1, $2... parameters
+        '''
+        self.__statements[name] = (types, query)
+
+    def execute_prepared(self, name, args=()):
+        '''Execute a registered statement and return its rows
+
+        The statement is parsed and planned once per connection, every
+        execution only sends its parameters.
+
+        :param name: the name of the statement
+        :param args: the parameters of the statement
+        '''
+        idle = self._idle()
+        cursor = self._connection().cursor()
+        if name not in self.__prepared:
+            types, query = self.__statements[name]
+            # prepared statements live as long as the session, not the transaction
+            cursor.execute('SELECT 1 FROM pg_prepared_statements WHERE name = %s', (name,))
+            if cursor.fetchone() is None:
+                self.logger.debug('SQL: PREPARE %s: %s' % (name, query))
+                cursor.execute('PREPARE %s (%s) AS %s' % (name, types, query) if types
+                               else 'PREPARE %s AS %s' % (name, query))
+            self.__prepared.add(name)
+        start = time.perf_counter()
+        if args:
+            cursor.execute('EXECUTE %s (%s)' % (name, ', '.join(['%s'] * len(args))), args)
+        else:
+            cursor.execute('EXECUTE %s' % name)
+        rows = cursor.fetchall()
+        if self.query_stats is not None:
+            self._record(self.__statements[name][1], start, len(rows))
+        self._end_read(idle)
+        return rows
 
     # system methods
 
     def commit(self):
-        if not self.__squash:
+        if not self.__squash and self.__connection is not None:
             self.__connection.commit()
 
+    def rollback(self):
+        if self.__connection is not None:
+            self.__connection.rollback()
+
     # write here your methods which SQL requests
 
     def search_company_id(self, name, getmax=1, strict=False):
         '''
         Try to find the id of a company in our database.
 
+        Companies are ranked in one query served by the trigram index of their
+        names: exact name, then same name ignoring case, then names starting
+        with name, containing name, and containing name ignoring case.
+        Only the best rank counts when one answer is wanted.
+
         :param name: name of the company (or part of)
         :getmax: number of answers wanted
+        :strict: with getmax 1, only accept the exact name
         :return: the id of the company if known. 0 if unknown.
 
-        >>> db = TimescaleStockMarketModel('bourse', 'ricou', 'localhost', 'monmdp') # doctest: +ELLIPSIS
-        Logs...
+        >>> db = TimescaleStockMarketModel('bourse', 'ricou', 'localhost', 'monmdp')
         >>> db.search_company_id("total")
         892
         >>> db.search_company_id("A")   # too many
@@ -214,20 +842,12 @@ class TimescaleStockMarketModel:
         >>> db.search_company_id("Should not exist !!")
         0
         '''
-        if getmax > 1:
-            res = self.raw_query('SELECT (id) FROM companies WHERE LOWER(name) LIKE LOWER(%s)',
-                                 ('%' + name + '%',))
-        else:
-            res = self.raw_query('SELECT (id) FROM companies WHERE name = %s', (name,))
-            if len(res) == 0 and not strict:
-                res = self.raw_query('SELECT (id) FROM companies WHERE LOWER(name) LIKE LOWER(%s)', (name,))
-                if len(res) == 0:
-                    res = self.raw_query('SELECT (id) FROM companies WHERE name LIKE %s', (name + '%',))
-                    if len(res) == 0:
-                        res = self.raw_query('SELECT (id) FROM companies WHERE name LIKE %s', ('%' + name + '%',))
-                        if len(res) == 0:
-                            res = self.raw_query('SELECT (id) FROM companies WHERE LOWER(name) LIKE LOWER(%s)',
-                                                 ('%' + name + '%',))
+        # getmax rows are enough to know whether there are too many answers,
+        # and two to know whether the best rank is ambiguous
+        res = self.raw_query(SEARCH_COMPANY_QUERY, {'name': name, 'limit': max(getmax, 2)})
+        if getmax <= 1:
+            best = 0 if strict else res[0][1] if res else 0
+            res = [r for r in res if r[1] == best]
         if len(res) == 1:
             return res[0][0]
         elif len(res) > 1 and len(res) < getmax:
@@ -239,7 +859,20 @@ class TimescaleStockMarketModel:
         '''
         Check if a file has already been included in the DB
         '''
-        return  self.raw_query("SELECT EXISTS ( SELECT 1 FROM file_done WHERE name = '%s' );" % name)[0][0]
+        return self.execute_prepared('is_file_done', (name,))[0][0]
+
+    def get_files_done(self):
+        '''
+        Return the set of the names of the files already included in the DB, in one query
+        '''
+        return set(self.query_arrays('SELECT name FROM file_done').get('name', ()))
+
+    def add_files_done(self, names, commit=True, table='file_done'):
+        '''
+        Mark files as included in the DB. Names already marked are ignored.
+        '''
+        self.execute('INSERT INTO ' + table + ' (name) SELECT unnest(%s) ON CONFLICT DO NOTHING',
+                     (list(names),), commit=commit)
 
 
 #
@@ -251,4 +884,5 @@ if __name__ == "__main__":
 
     # timescaleDB shoul run, possibly in Docker
     db = TimescaleStockMarketModel('bourse', 'ricou', 'localhost', 'monmdp')
+    db.setup_database()
     doctest.testmod()
@@ -0,0 +1,15 @@
+/**
+ * Width of the stock graph in pixels, to downsample its traces
+ */
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+  graph: {
+    graph_width: function (relayoutData) {
+      var elem = document.getElementById("stock-graph");
+
+      if (!elem) {
+        return window.dash_clientside.no_update;
+      }
+      return elem.offsetWidth;
+    }
+  }
+});
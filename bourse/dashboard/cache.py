@@ -0,0 +1,98 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+# columns kept as integers, float32 is exact only up to 2^24
+INTEGER_COLUMNS = ("volume",)
+
+
+def compact(df: pd.DataFrame) -> dict:
+    """Convert a fetched series to compact arrays sorted by date: UTC datetime64 dates, int64 volumes, float32 values"""
+    if "date" in df.columns:
+        df = df.sort_values("date", kind="stable")
+    arrays = {}
+    for column in df.columns:
+        if column == "date":
+            dates = pd.to_datetime(df[column], utc=True).dt.tz_localize(None)
+            arrays[column] = dates.to_numpy(dtype="datetime64[ns]")
+        elif column in INTEGER_COLUMNS:
+            values = pd.to_numeric(df[column])
+            # NULL volumes keep the exactness of float64 up to 2^53
+            dtype = np.float64 if values.isna().any() else np.int64
+            arrays[column] = values.to_numpy(dtype=dtype)
+        else:
+            arrays[column] = pd.to_numeric(df[column]).to_numpy(dtype=np.float32)
+    return arrays
+
+
+def expand(arrays: dict) -> pd.DataFrame:
+    """Convert compact arrays back to a dataframe, without copying them"""
+    return pd.DataFrame(arrays, copy=False)
+
+
+class SeriesCache:
+    """
+    LRU cache of the series of the companies, keyed by (cid, resolution).
+    It is shared by every callback and session of the process, and holds
+    at most max_bytes of arrays: the least recently used series are evicted
+    first. Each gunicorn worker has its own cache, so the memory used is
+    max_bytes times the number of workers. Entries older than ttl seconds are fetched again, so that the
+    data loaded by the analyzer shows up.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float = 3600):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (time of insertion, arrays, size in bytes), least recent first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the arrays of a series, None if not cached"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, arrays: dict):
+        """Cache the arrays of a series, evicting the least recently used ones"""
+        size = sum(array.nbytes for array in arrays.values())
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic(), arrays, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        self.nbytes -= self._entries.pop(key)[2]
+
+    def stats(self) -> dict:
+        """Return the counters of the cache"""
+        with self._lock:
+            return dict(
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+                entries=len(self._entries),
+                bytes=self.nbytes,
+                max_bytes=self.max_bytes,
+            )
@@ -0,0 +1,40 @@
+import numpy as np
+
+
+def visible_slice(x, start=None, end=None):
+    """Bounds of the points of a sorted x inside [start, end], with one more point on each side so the line reaches the edges"""
+    lo = 0 if start is None else max(np.searchsorted(x, start, side="left") - 1, 0)
+    hi = (
+        len(x)
+        if end is None
+        else min(np.searchsorted(x, end, side="right") + 1, len(x))
+    )
+    return lo, hi
+
+
+def minmax(x, y, start=None, end=None, buckets=1000):
+    """
+    Downsample a series sorted on x to the visible range [start, end], keeping
+    the lowest and highest point of each bucket. The buckets split the range
+    evenly, one per pixel of the graph, so the line drawn looks the same as
+    the full series while it has at most 2 points per pixel, whatever the
+    length of the history.
+    """
+    lo, hi = visible_slice(x, start, end)
+    x, y = x[lo:hi], y[lo:hi]
+    notna = ~np.isnan(y)
+    x, y = x[notna], y[notna]
+    if len(x) <= 2 * buckets:
+        return x, y
+
+    xi = x.view("int64")
+    edges = np.linspace(xi[0], xi[-1], buckets + 1)
+    ids = np.clip(np.searchsorted(edges, xi, side="right") - 1, 0, buckets - 1)
+
+    # Sort each bucket on y: its first point is the lowest, its last the highest
+    order = np.lexsort((y, ids))
+    ends = np.flatnonzero(np.diff(ids)) + 1
+    starts = np.concatenate(([0], ends))
+    ends = np.concatenate((ends, [len(ids)]))
+    keep = np.unique(np.concatenate((order[starts], order[ends - 1], [0, len(x) - 1])))
+    return x[keep], y[keep]
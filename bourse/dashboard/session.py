@@ -0,0 +1,63 @@
+import os
+from contextlib import contextmanager
+
+import diskcache
+
+# The sessions live in a disk cache shared by the worker processes of the
+# dashboard, so any worker can serve any request of a session. The client
+# only keeps the id of its session.
+SESSION_DIR = os.getenv("SESSION_DIR", "/tmp/bourse-sessions")
+SESSION_TTL = float(os.getenv("SESSION_TTL", 24 * 3600))
+SESSION_CACHE_BYTES = int(os.getenv("SESSION_CACHE_BYTES", 256 * 1024 * 1024))
+
+_cache = diskcache.Cache(SESSION_DIR, size_limit=SESSION_CACHE_BYTES)
+
+
+class Session:
+    """
+    State of the dashboard of one user: the selected market, the selection and
+    the graph. It stays a few hundred bytes, the series of the symbols are
+    read from the series cache of the worker, the companies of the markets
+    from the shared cache.
+    """
+
+    def __init__(self):
+        self.market_id = None
+        self.selected_companies, self.selected_symbols = set(), set()
+        # symbols whose traces are in the graph, in the order of the traces
+        self.figure_symbols = []
+        # visible range of the graph, None when it fits the data
+        self.x_range = None
+
+
+@contextmanager
+def session(session_id, save=True):
+    """
+    Load the state of a session and store it back at the end of the with block,
+    unless save is False for the callbacks that only read it.
+    The callbacks that change a session are serialized, so that concurrent
+    callbacks of the same session, on any worker, do not lose each other's updates.
+    """
+    if not save:
+        state = _cache.get(session_id)
+        yield state if state is not None else Session()
+        return
+
+    with diskcache.Lock(_cache, f"lock-{session_id}", expire=300):
+        state = _cache.get(session_id)
+        if state is None:
+            state = Session()
+        yield state
+        _cache.set(session_id, state, expire=SESSION_TTL)
+
+
+def shared(key, compute, expire):
+    """
+    Value of key in the cache shared by the workers, computed and stored
+    for expire seconds when missing
+    """
+    value = _cache.get(key)
+    if value is None:
+        value = compute()
+        _cache.set(key, value, expire=expire)
+    return value
@@ -0,0 +1,215 @@
+"""
+    End to end benchmark of the analyzer.
+
+    Generate a synthetic boursorama corpus (pickled snapshots named
+    "<alias> <timestamp>.bz2", with symbol, name, last and volume columns)
+    and run analyzer.process_files on it, writing either nowhere (null sink)
+    or into a local TimescaleDB. Report the wall time and rows/s of each
+    stage and the peak RSS.
+
+    usage: python tools/benchmarks/bench_analyzer.py [--markets N] [--companies N]
+                  [--days N] [--snapshots N] [--sink null|postgres] [--corpus DIR]
+                  [--backfill [--staging]] [--spool DIR]
+"""
+import argparse
+import os
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from functools import partial
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "bourse", "analyzer"))
+import timescaledb_model as tsdb  # noqa: E402
+from analyzer import process_files  # noqa: E402
+from commit import Committer  # noqa: E402
+from loader import Prefetcher  # noqa: E402
+from mylogging import INFO, getLogger  # noqa: E402
+from processor import Processor  # noqa: E402
+from registry import CompanyRegistry  # noqa: E402
+from spool import Spool, run_loader  # noqa: E402
+from timer import StageTimer  # noqa: E402
+
+ALIASES = ["amsterdam", "bruxelle", "compA", "compB", "dbx", "euronx",
+           "lse", "mercados", "milano", "peapme", "xetra"]
+
+log = getLogger("bench_analyzer", level=INFO)
+
+
+class NullSink:
+    """
+        Stand-in for TimescaleStockMarketModel that stores nothing,
+        to measure the analyzer without the database.
+    """
+    logger = log
+    query_stats = None
+
+    def df_copy(self, df, table, **kwargs):
+        pass
+
+    def df_write(self, df, table, **kwargs):
+        pass
+
+    def copy_batch(self, frames, files, table="file_done"):
+        pass
+
+    def df_write_batch(self, frames, files, table="file_done"):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def raw_query(self, query, args=None):
+        return []
+
+    def query_arrays(self, query, args=None, **kwargs):
+        return {}
+
+    def execute_prepared(self, name, args=()):
+        # every market is market 1
+        return [(1,)]
+
+    def get_files_done(self):
+        return set()
+
+    def add_files_done(self, names, commit=True, table="file_done"):
+        pass
+
+    def setup_database(self):
+        pass
+
+    def drop_indexes(self):
+        pass
+
+    def create_indexes(self):
+        pass
+
+    def create_staging_tables(self):
+        pass
+
+    def merge_staging_tables(self):
+        pass
+
+
+def generate_corpus(dir, markets, companies, days, snapshots, seed=0):
+    """
+        Write a synthetic corpus, one directory per year like the real one
+        @param dir: the directory to write into
+        @param markets: the number of markets
+        @param companies: the number of companies per market
+        @param days: the number of trading days
+        @param snapshots: the number of snapshots per day and market
+        @return: the number of files written
+    """
+    rng = np.random.default_rng(seed)
+    nb_files = 0
+    for alias in ALIASES[:markets]:
+        symbols = np.array([f"1r{alias[:2].upper()}{i:05d}" for i in range(companies)])
+        names = np.array([f"{alias.upper()} COMPANY {i}" for i in range(companies)])
+        prices = np.round(rng.lognormal(3, 1.5, companies), 2)
+        day = datetime(2020, 1, 1)
+        for _ in range(days):
+            while day.weekday() >= 5:
+                day += timedelta(days=1)
+            volumes = np.zeros(companies, dtype=np.int64)
+            for snapshot in range(snapshots):
+                date = day + timedelta(hours=9, minutes=snapshot * 510 // snapshots,
+                                       microseconds=int(rng.integers(1e6)))
+                # most values do not change between two snapshots
+                moving = rng.random(companies) < 0.3
+                prices[moving] = np.round(prices[moving] * rng.normal(1, 0.002, moving.sum()), 2)
+                volumes[moving] += rng.integers(1, 1000, moving.sum())
+                last = pd.Series(prices, dtype=object)
+                suffixed = rng.random(companies) < 0.05
+                last[suffixed] = [f"{p}(c)" for p in prices[suffixed]]
+                df = pd.DataFrame(
+                    {"symbol": symbols, "name": names, "last": last.to_numpy(), "volume": volumes},
+                    index=pd.Index(symbols, name="symbol"),
+                )
+                path = os.path.join(dir, str(day.year), f"{alias} {date}.bz2")
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                df.to_pickle(path)
+                nb_files += 1
+            day += timedelta(days=1)
+    return nb_files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--markets", type=int, default=2)
+    parser.add_argument("--companies", type=int, default=500)
+    parser.add_argument("--days", type=int, default=10)
+    parser.add_argument("--snapshots", type=int, default=20)
+    parser.add_argument("--corpus", help="reuse or keep the corpus in this directory")
+    parser.add_argument("--sink", choices=["null", "postgres"], default="null")
+    parser.add_argument("--host", default="localhost", help="host of the postgres sink")
+    parser.add_argument("--pool-size", type=int, default=os.cpu_count())
+    parser.add_argument("--read-ahead", type=int, default=os.cpu_count())
+    parser.add_argument("--loader", choices=["process", "thread"], default="process")
+    parser.add_argument("--write-method", choices=["copy", "to_sql"], default="copy")
+    parser.add_argument("--backfill", action="store_true",
+                        help="load without the secondary indexes and build them at the end")
+    parser.add_argument("--staging", action="store_true",
+                        help="with --backfill, load into UNLOGGED staging tables")
+    parser.add_argument("--spool", metavar="DIR",
+                        help="write the batches into a spool drained by a loader process")
+    args = parser.parse_args()
+
+    corpus = args.corpus or tempfile.mkdtemp(prefix="bourse-corpus-")
+    if not os.path.isdir(corpus) or not os.listdir(corpus):
+        start = time.perf_counter()
+        nb_files = generate_corpus(corpus, args.markets, args.companies, args.days, args.snapshots)
+        log.info(f"{nb_files} files generated in {corpus} in {time.perf_counter() - start:.1f}s")
+
+    if args.sink == "null":
+        db_factory = NullSink
+    else:
+        db_factory = partial(tsdb.TimescaleStockMarketModel, "bourse", "ricou", args.host, "monmdp")
+
+    timer = StageTimer()
+    spool = Spool(args.spool) if args.spool else None
+    committer = Committer(log, args.pool_size, args.write_method, db_factory=db_factory, timer=timer,
+                          staging=args.staging, spool=spool)
+    committer.db.setup_database()
+    if args.backfill:
+        committer.db.drop_indexes()
+        if args.staging:
+            committer.db.create_staging_tables()
+    processor = Processor(log, CompanyRegistry(committer.get_companies()), timer)
+    prefetcher = Prefetcher(args.read_ahead, args.loader, timer)
+
+    start = time.perf_counter()
+    if spool is not None:
+        stop_loader = get_context("spawn").Event()
+        spool_loader = get_context("spawn").Process(
+            target=run_loader, args=(args.spool, stop_loader, db_factory))
+        spool_loader.start()
+    nb_files, nb_companies = process_files(corpus, processor, committer, prefetcher)
+    committer.join()
+    if spool is not None:
+        stop_loader.set()
+        with timer.stage("spool"):
+            spool_loader.join()
+    if args.backfill:
+        if args.staging:
+            with timer.stage("merge"):
+                committer.db.merge_staging_tables()
+        with timer.stage("indexes"):
+            committer.db.create_indexes()
+    elapsed = time.perf_counter() - start
+
+    print(f"{nb_files} files, {nb_companies} companies in {elapsed:.3f}s"
+          f" ({nb_files / elapsed:.1f} files/s)")
+    for line in timer.report():
+        print(line)
+    # ru_maxrss is in kilobytes on Linux
+    print(f"peak RSS: main {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB,"
+          f" workers {resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024:.0f} MB")
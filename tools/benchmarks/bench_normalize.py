@@ -0,0 +1,60 @@
+"""
+    Micro-benchmark of the value normalization of Processor.
+
+    Compare the string based conversion (astype(str), str.replace,
+    astype(float)) with processor.normalize_values on a snapshot shaped
+    like a boursorama file: mostly numbers, some values with a "(c)"
+    or "(s)" suffix and some with a thousands separator.
+
+    usage: python tools/benchmarks/bench_normalize.py [--rows N] [--repeat N]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "bourse", "analyzer"))
+from processor import normalize_values  # noqa: E402
+
+
+def make_snapshot(rows, noisy=0.05, seed=0):
+    """
+        Build the "last" column of a snapshot
+        @param rows: the number of companies in the snapshot
+        @param noisy: the share of values with a suffix
+    """
+    rng = np.random.default_rng(seed)
+    prices = np.round(rng.lognormal(3, 1.5, rows), 2)
+    values = pd.Series(prices, dtype=object)
+    if not noisy:
+        return values
+    suffixed = rng.random(rows) < noisy
+    values[suffixed] = [f"{p}({rng.choice(['c', 's'])})" for p in prices[suffixed]]
+    large = (prices >= 1000) & ~suffixed
+    values[large] = [f"{int(p) // 1000} {p % 1000:07.3f}" for p in prices[large]]
+    return values
+
+
+def string_normalize(values):
+    values = values.astype(str)
+    values = values.str.replace(r"\([a-zA-Z]\)| ", "", regex=True)
+    return values.astype(float)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--rows", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    for snapshot, noisy in (("mixed", 0.05), ("numbers", 0)):
+        values = make_snapshot(args.rows, noisy)
+        pd.testing.assert_series_equal(string_normalize(values), normalize_values(values))
+
+        for name, function in (("string", string_normalize), ("fast", normalize_values)):
+            seconds = min(timeit.repeat(lambda: function(values), number=args.repeat, repeat=3))
+            print(f"{snapshot:>8} {name:>6}: {seconds / args.repeat * 1e6:9.1f} us"
+                  f" per snapshot of {args.rows} rows")
@@ -0,0 +1,114 @@
+"""
+    Benchmark of TimescaleStockMarketModel.search_company_id on a large
+    company table.
+
+    Fill a temporary "companies" table (it hides the real one for the
+    connection of the model, nothing is written to the database) with
+    synthetic names, index it like setup_database does, and compare the
+    ranked trigram lookup with the former cascade of LIKE queries on exact
+    names, names in lower case, prefixes, substrings and unknown names.
+    The two must give the same answers.
+
+    usage: python tools/benchmarks/bench_search_company.py [--companies N] [--queries N]
+                  [--host HOST]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "bourse", "analyzer"))
+import timescaledb_model as tsdb  # noqa: E402
+
+WORDS = ["total", "air", "bank", "credit", "energie", "global", "holding", "immo",
+         "invest", "media", "nord", "pharma", "rail", "sante", "tech", "union"]
+
+
+def legacy_search_company_id(db, name, getmax=1, strict=False):
+    """
+        The cascade of LIKE queries search_company_id used to run
+    """
+    if getmax > 1:
+        res = db.raw_query('SELECT (id) FROM companies WHERE LOWER(name) LIKE LOWER(%s)',
+                           ('%' + name + '%',))
+    else:
+        res = db.raw_query('SELECT (id) FROM companies WHERE name = %s', (name,))
+        if len(res) == 0 and not strict:
+            res = db.raw_query('SELECT (id) FROM companies WHERE LOWER(name) LIKE LOWER(%s)', (name,))
+            if len(res) == 0:
+                res = db.raw_query('SELECT (id) FROM companies WHERE name LIKE %s', (name + '%',))
+                if len(res) == 0:
+                    res = db.raw_query('SELECT (id) FROM companies WHERE name LIKE %s', ('%' + name + '%',))
+                    if len(res) == 0:
+                        res = db.raw_query('SELECT (id) FROM companies WHERE LOWER(name) LIKE LOWER(%s)',
+                                           ('%' + name + '%',))
+    if len(res) == 1:
+        return res[0][0]
+    elif len(res) > 1 and len(res) < getmax:
+        return sorted(r[0] for r in res)
+    else:
+        return 0
+
+
+def make_names(companies, seed=0):
+    """
+        Build unique company names of two to three words and a number
+        @param companies: the number of names
+    """
+    rng = np.random.default_rng(seed)
+    words = rng.choice(WORDS, size=(companies, 3))
+    return [f"{a.upper()} {b.capitalize()} {c} {i}" for i, (a, b, c) in enumerate(words)]
+
+
+def make_queries(names, queries, seed=1):
+    """
+        Build (name, getmax, strict) searches of every kind
+        @param names: the names of the companies
+        @param queries: the number of searches of each kind
+    """
+    rng = np.random.default_rng(seed)
+    picked = [names[i] for i in rng.integers(len(names), size=queries)]
+    return {
+        "exact": [(n, 1, False) for n in picked],
+        "lower case": [(n.lower(), 1, False) for n in picked],
+        "prefix": [(n.rsplit(" ", 1)[0][:-2], 1, False) for n in picked],
+        "substring": [(n.split(" ", 1)[1], 1, False) for n in picked],
+        "several": [(n.split(" ")[1] + " " + n.split(" ")[2][:3], 10, False) for n in picked],
+        "unknown": [(f"no company {i}", 1, False) for i in range(queries)],
+    }
+
+
+def run(search, db, queries):
+    start = time.perf_counter()
+    answers = []
+    for name, getmax, strict in queries:
+        answer = search(db, name, getmax, strict)
+        answers.append(sorted(answer) if isinstance(answer, list) else answer)
+    return time.perf_counter() - start, answers
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--companies", type=int, default=200000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--host", default="localhost")
+    args = parser.parse_args()
+
+    db = tsdb.TimescaleStockMarketModel("bourse", "ricou", args.host, "monmdp")
+    db.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    db.execute("CREATE TEMP TABLE companies (id INTEGER PRIMARY KEY, name VARCHAR)")
+    db.execute("INSERT INTO companies SELECT * FROM unnest(%s::integer[], %s::varchar[])",
+               (list(range(1, args.companies + 1)), make_names(args.companies)))
+    db.execute(tsdb.INDEXES["idx_name_companies"].replace("IF NOT EXISTS ", ""))
+    db.execute("ANALYZE companies")
+
+    for kind, queries in make_queries(make_names(args.companies), args.queries).items():
+        legacy_time, legacy = run(legacy_search_company_id, db, queries)
+        ranked_time, ranked = run(tsdb.TimescaleStockMarketModel.search_company_id, db, queries)
+        agree = sum(a == b for a, b in zip(legacy, ranked))
+        print(f"{kind:>10}: cascade {1000 * legacy_time / len(queries):7.2f} ms/query,"
+              f" ranked {1000 * ranked_time / len(queries):7.2f} ms/query"
+              f" ({legacy_time / ranked_time:.1f}x), {agree}/{len(queries)} same answers")
+    db.rollback()